@@ -55,21 +55,24 @@ setup(
     python_requires='>=3.9',
     install_requires=[
         'ZODB3 >= 3.8dev',
-        'zope.app.container',  # would be nice to remove this
-        'zope.app.intid',
+        'zope.container',
+        'zope.intid',
         'zope.interface',
         'zope.component',
-        'zope.app.keyreference',
+        'zope.keyreference',
+        'zope.lifecycleevent',
         'zope.location',
         'zope.index',
         'zc.relation >= 1.1',
-        'zope.app.testing',
-        'zope.app.component',
-        'zope.testing',
         'setuptools',
     ],
     extras_require=dict(
         test=[
+            'zope.app.component',
             'zope.app.folder',
+            'zope.app.intid',
+            'zope.app.keyreference',
+            'zope.app.testing',
+            'zope.testing',
         ]),
 )
@@ -12,6 +12,24 @@
 #
 ##############################################################################
 """Relationships"""
-from zc.relationship.index import Index  # noqa
-from zc.relationship.intid import Container  # noqa
-from zc.relationship.shared import Relationship  # noqa
+import importlib
+
+
+# These are imported when first used, so that importing the index alone
+# does not import the container framework.
+_lazy = {
+    'Index': 'zc.relationship.index',
+    'Container': 'zc.relationship.intid',
+    'Relationship': 'zc.relationship.shared',
+}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(
+            f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module(_lazy[name]), name)
+
+
+def __dir__():
+    return sorted(set(globals()).union(_lazy))
@@ -0,0 +1,113 @@
+##############################################################################
+#
+# Copyright (c) 2006-2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Searches across several relationship containers.
+
+$Id$
+"""
+import functools
+
+import zc.relation.catalog
+import zope.component.hooks
+
+from zc.relationship import shared
+
+
+def _getTokenInfo(ix, name):
+    for info in ix.iterValueIndexInfo():
+        if info['name'] == name:
+            return info['dump'], info['load'], info['btree']
+    raise ValueError('no value index', name)
+
+
+class FederatedContainer(shared.ByDepthMixin):
+    """Searches the relationships of several containers as one graph.
+
+    The containers (`AbstractContainer` instances, such as one per tenant or
+    per database mount) must use the same value tokens: the same dump and
+    load functions, and the same BTree families.  A search follows
+    relationships in all of them, so a target found in one container is a
+    source for the next step in all of the others.
+
+    Each step of a search asks every container for the next values.  The
+    `map` argument, with the signature of the builtin `map` (the default),
+    runs these per-container steps; pass the `map` method of a
+    `concurrent.futures` executor to run them concurrently.  That is only
+    safe if no two containers share a ZODB connection, since connections
+    must not be used by more than one thread at a time.  Each step runs in
+    the site of the search, so that filters find its local utilities.
+    """
+
+    def __init__(self, containers, map=map):
+        self.containers = tuple(containers)
+        if not self.containers:
+            raise ValueError('at least one container is required')
+        first = self.containers[0].relationIndex
+        for container in self.containers[1:]:
+            for name in ('source', 'target'):
+                if (_getTokenInfo(container.relationIndex, name) !=
+                        _getTokenInfo(first, name)):
+                    raise ValueError('incompatible value tokens', container)
+        self.map = map
+
+    @property
+    def relationIndex(self):
+        # the index used to tokenize and resolve values
+        return self.containers[0].relationIndex
+
+    def _expandTokens(self, tokens, fromName, toName, filter):
+        tools = self.relationIndex.getValueModuleTools(toName)
+        expand = functools.partial(
+            _expand, tokens=tokens, fromName=fromName, toName=toName,
+            filter=filter, site=zope.component.hooks.getSite())
+        return zc.relation.catalog.multiunion(
+            self.map(expand, self.containers), tools)
+
+    def _findTokens(self, value, fromName, toName, maxDepth, filter):
+        tools = self.relationIndex.getValueModuleTools(toName)
+        return zc.relation.catalog.multiunion(
+            self._findTokensByDepth(value, fromName, toName, maxDepth, filter),
+            tools)
+
+    def findTargetTokens(self, source, maxDepth=1, filter=None):
+        return self._findTokens(source, 'source', 'target', maxDepth, filter)
+
+    def findSourceTokens(self, target, maxDepth=1, filter=None):
+        return self._findTokens(target, 'target', 'source', maxDepth, filter)
+
+    def findTargets(self, source, maxDepth=1, filter=None):
+        return self.relationIndex.resolveValueTokens(
+            self.findTargetTokens(source, maxDepth, filter), 'target')
+
+    def findSources(self, target, maxDepth=1, filter=None):
+        return self.relationIndex.resolveValueTokens(
+            self.findSourceTokens(target, maxDepth, filter), 'source')
+
+    def isLinked(self, source, target, maxDepth=1, filter=None):
+        token = self.relationIndex.tokenizeQuery({'target': target})['target']
+        for layer in self.findTargetTokensByDepth(source, maxDepth, filter):
+            if token in layer:
+                return True
+        return False
+
+
+def _expand(container, tokens, fromName, toName, filter, site):
+    # an executor may run this in a thread without a site, where filters
+    # that resolve relationships could not find local utilities such as
+    # intids: use the site of the search
+    old = zope.component.hooks.getSite()
+    zope.component.hooks.setSite(site)
+    try:
+        return container._expandTokens(tokens, fromName, toName, filter)
+    finally:
+        zope.component.hooks.setSite(old)
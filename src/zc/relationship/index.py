@@ -12,15 +12,26 @@
 #
 ##############################################################################
 
+import collections
+import hashlib
+import heapq
+import itertools
+import math
+import time
+import types
+
 import BTrees
+import BTrees.Length
 import persistent
 import persistent.interfaces
+import persistent.list
+import transaction
 import zc.relation.catalog
-import zope.app.container.contained
+import zc.relation.interfaces
 import zope.interface.interfaces
+import zope.location.interfaces
 from zope import component
 from zope import interface
-from zope.app.intid.interfaces import IIntIds
 
 from zc.relationship import interfaces
 
@@ -36,6 +47,8 @@ from zc.relationship import interfaces
 
 CircularRelationshipPath = zc.relation.catalog.CircularRelationPath
 
+_marker = object()
+
 ##############################################################################
 # a common case transitive queries factory
 
@@ -77,6 +90,19 @@ class TransposingTransitiveQueriesFactory(persistent.Persistent):
                 res.update(static)
                 yield res
 
+    def getTransposition(self, query):
+        """return (queryName, valueName) if the transitive queries for query
+        are simply {queryName: token} for each token of the valueName values of
+        the last relationship; otherwise None.
+
+        This is the case when the query has a single key that is one of the
+        two names."""
+        if len(query) == 1:
+            name = list(query.keys())[0]
+            if name is not None and name in self.names:
+                return (name, self.names[not self.names.index(name)])
+        return None
+
 
 def factoryWrapper(factory, query, index):
     cache = {}
@@ -85,24 +111,1029 @@ def factoryWrapper(factory, query, index):
         if not relchain:
             return (query,)
         return factory(relchain, query, index, cache)
+    # the index can walk the postings directly for the common transposition,
+    # unless a subclass has changed how the queries are made.
+    if (isinstance(factory, TransposingTransitiveQueriesFactory) and
+            type(factory).__call__ is
+            TransposingTransitiveQueriesFactory.__call__):
+        getQueries.transposition = factory.getTransposition(query)
     return getQueries
 
+##############################################################################
+# limits for chain searches
+
+
+class _LimitReached(Exception):
+    pass
+
+
+class _Bounds:
+    # counts the relationships a search visits, stopping the search when too
+    # many have been visited or it has run out of time.
+
+    def __init__(self, maxVisited, timeBudget):
+        if maxVisited is not None and (
+                not isinstance(maxVisited, int) or maxVisited < 1):
+            raise ValueError('invalid maxVisited', maxVisited)
+        if timeBudget is not None:
+            if (not isinstance(timeBudget, (int, float)) or
+                    timeBudget <= 0):
+                raise ValueError('invalid timeBudget', timeBudget)
+            self.deadline = time.monotonic() + timeBudget
+        else:
+            self.deadline = None
+        self.maxVisited = maxVisited
+        self.visited = 0
+
+    def wrapFilter(self, filter):
+        def checkBounds(relchain, query, index, cache):
+            self.visited += 1
+            if (self.maxVisited is not None and
+                    self.visited > self.maxVisited):
+                raise _LimitReached()
+            if (self.deadline is not None and
+                    time.monotonic() > self.deadline):
+                raise _LimitReached()
+            return filter is None or filter(relchain, query, index, cache)
+        return checkBounds
+
+
+class BoundedResult:
+    """An iterator of search results that may stop before the search is done.
+
+    After iteration, `truncated` is True if the search stopped because it
+    reached the limit of results, of visited relationships, or of time, and
+    False if all results were found."""
+
+    def __init__(self, iterable, limit=None, source=None):
+        if limit is not None and (not isinstance(limit, int) or limit < 0):
+            raise ValueError('invalid limit', limit)
+        self._iterator = iter(iterable)
+        self._limit = limit
+        self._count = 0
+        self._truncated = False
+        self._source = source
+
+    @property
+    def truncated(self):
+        return self._truncated or (
+            self._source is not None and self._source.truncated)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            res = next(self._iterator)
+        except _LimitReached:
+            self._stop()
+        if self._limit is not None:
+            if self._count >= self._limit:
+                # we found one more than we may return.
+                self._stop()
+            self._count += 1
+        return res
+
+    def _stop(self):
+        self._truncated = True
+        self._iterator = iter(())
+        raise StopIteration
+
+    def map(self, func):
+        """return a BoundedResult of func(self), sharing its truncation.
+
+        func takes an iterable and returns an iterable."""
+        return BoundedResult(func(self), source=self)
+
+
 ##############################################################################
 # a common case intid getter and setter
 
 
-def generateToken(obj, index, cache):
+def _getIntIdsInterface():
+    # imported when first needed: zope.intid imports much of the container
+    # and security frameworks, which an index that does not use intids can
+    # do without.
+    from zope.intid.interfaces import IIntIds
+    return IIntIds
+
+
+def _getIntIds(cache):
     intids = cache.get('intids')
     if intids is None:
-        intids = cache['intids'] = component.getUtility(IIntIds)
-    return intids.register(obj)
+        intids = cache['intids'] = component.getUtility(
+            _getIntIdsInterface())
+    return intids
+
+
+def generateToken(obj, index, cache):
+    # look the id up first: for an object that has one, which is the common
+    # case, that is one lookup of its key, where register looks it up twice
+    intids = _getIntIds(cache)
+    res = intids.queryId(obj)
+    if res is None:
+        res = intids.register(obj)
+    return res
+
+
+def generateTokens(objs, index, cache):
+    """return a list of the tokens of objs, as generateToken makes them.
+
+    Each distinct object is looked up once.  Then only the objects that
+    have no id yet are registered."""
+    intids = _getIntIds(cache)
+    objs = list(objs)
+    tokens = {}
+    new = []
+    for obj in objs:
+        if id(obj) not in tokens:
+            token = tokens[id(obj)] = intids.queryId(obj)
+            if token is None:
+                new.append(obj)
+    for obj in new:
+        tokens[id(obj)] = intids.register(obj)
+    return [tokens[id(obj)] for obj in objs]
 
 
 def resolveToken(token, index, cache):
-    intids = cache.get('intids')
-    if intids is None:
-        intids = cache['intids'] = component.getUtility(IIntIds)
-    return intids.getObject(token)
+    return _getIntIds(cache).getObject(token)
+
+##############################################################################
+# an optional index of the relationships directly linking two values
+
+
+def _pairs(tokens1, tokens2):
+    for t1 in tokens1 or ():
+        for t2 in tokens2 or ():
+            yield (t1, t2)
+
+
+class _PairListener(persistent.Persistent):
+    # an index listener that follows the (name1 token, name2 token) pairs of
+    # each relationship.  Subclasses define _add and _remove, called with a
+    # relationship token and an iterable of its pairs that were added or
+    # removed, and _clear.
+
+    catalog = None
+
+    def __init__(self, name1, name2):
+        self.names = (name1, name2)
+
+    def _iterPairs(self, catalog):
+        name1, name2 = self.names
+        for relToken in catalog.getRelationTokens():
+            yield relToken, _pairs(
+                catalog.getValueTokens(name1, relToken),
+                catalog.getValueTokens(name2, relToken))
+
+    def _index(self, catalog):
+        for relToken, pairs in self._iterPairs(catalog):
+            self._add(relToken, pairs)
+
+    # IListener
+
+    def relationAdded(self, token, catalog, additions):
+        self._add(token, _pairs(*(additions.get(nm) for nm in self.names)))
+
+    def relationModified(self, token, catalog, additions, removals):
+        if not [nm for nm in self.names if nm in additions or nm in removals]:
+            return
+        old = []
+        new = []
+        for nm in self.names:
+            current = set(catalog.getValueTokens(nm, token) or ())
+            new.append(current)
+            old.append(current.difference(additions.get(nm) or ()).union(
+                removals.get(nm) or ()))
+        old = set(_pairs(*old))
+        new = set(_pairs(*new))
+        self._remove(token, old - new)
+        self._add(token, new - old)
+
+    def relationRemoved(self, token, catalog, removals):
+        self._remove(token, _pairs(*(removals.get(nm) for nm in self.names)))
+
+    def sourceCleared(self, catalog):
+        self._clear()
+
+    def sourceAdded(self, catalog):
+        self.catalog = catalog
+        self._index(catalog)
+
+    def sourceRemoved(self, catalog):
+        self.catalog = None
+        self._clear()
+
+    def sourceCopied(self, original, copy):
+        copy.addListener(self.__class__(*self.names))
+
+
+@interface.implementer(zc.relation.interfaces.IListener)
+class PairIndex(_PairListener):
+    """Maps pairs of value tokens to the relationships that link them directly.
+
+    Install it as a listener of an index (``index.addListener(pairIndex)``);
+    it then keeps itself up-to-date as relationships are indexed and
+    unindexed.  ``getRelationshipTokens(token1, token2)`` returns the set of
+    relationship tokens that have token1 among their `name1` values and
+    token2 among their `name2` values.
+    """
+
+    def __init__(self, name1, name2):
+        super().__init__(name1, name2)
+        self._pairs = BTrees.family32.OO.BTree()
+
+    def getRelationshipTokens(self, token1, token2):
+        res = self._pairs.get((token1, token2))
+        if res is None:
+            res = self.catalog.getRelationModuleTools()['TreeSet']()
+        return res
+
+    def _add(self, relToken, pairs):
+        for pair in pairs:
+            rels = self._pairs.get(pair)
+            if rels is None:
+                rels = self._pairs[pair] = (
+                    self.catalog.getRelationModuleTools()['TreeSet']())
+            rels.insert(relToken)
+
+    def _remove(self, relToken, pairs):
+        for pair in pairs:
+            rels = self._pairs[pair]
+            rels.remove(relToken)
+            if not rels:
+                del self._pairs[pair]
+
+    def _clear(self):
+        self._pairs.clear()
+
+##############################################################################
+# an optional index of which values can reach which others
+
+
+@interface.implementer(zc.relation.interfaces.IListener)
+class ReachabilityIndex(_PairListener):
+    """Answers whether one value token can reach another, mostly by labels.
+
+    Relationships link each of their `name1` values to each of their `name2`
+    values, which must share tokens.  The index numbers the values in the
+    order of a depth-first walk of this graph, so that each value's
+    descendants in the walk's spanning forest have the numbers in a range
+    after its own: for trees, such as hierarchies, one value reaches another
+    if the other's number is in its range.  The links that are not in the
+    spanning forest are kept aside and followed when the ranges do not
+    answer.
+
+    Install it as a listener of an index (``index.addListener(reach)``).
+    Added links are kept aside, and values new to the index get numbers of
+    their own, so the labels stay correct but answers get slower as the
+    graph changes.  Removing a link of the spanning forest makes the labels
+    `stale`: ``isReachable`` then returns None, meaning that it does not
+    know.  Call ``relabel`` from time to time, such as when `stale` is true
+    or `extraLinks` has grown, to number the values again.
+    """
+
+    def __init__(self, name1, name2):
+        super().__init__(name1, name2)
+        self._links = BTrees.family32.OO.BTree()  # pair: number of rels
+        self._clearLabels()
+
+    def _clearLabels(self):
+        self._labels = BTrees.family32.OO.BTree()  # token: (first, last)
+        self._treeLinks = BTrees.family32.OO.TreeSet()
+        self._extraLinks = BTrees.family64.IO.BTree()  # first: OOTreeSet
+        self._next = 0
+        self.extraLinks = 0
+        self.stale = False
+
+    def _label(self, token):
+        # give a value new to the index a number of its own
+        label = self._labels.get(token)
+        if label is None:
+            label = self._labels[token] = (self._next, self._next)
+            self._next += 1
+        return label
+
+    def _addExtraLink(self, token1, token2):
+        first = self._label(token1)[0]
+        targets = self._extraLinks.get(first)
+        if targets is None:
+            targets = self._extraLinks[first] = BTrees.family32.OO.TreeSet()
+        if targets.insert(token2):
+            self.extraLinks += 1
+
+    def _successors(self, token):
+        for token1, token2 in self._links.keys(min=(token,)):
+            if token1 != token:
+                break
+            yield token2
+
+    def relabel(self):
+        """number the values again, and clear the `stale` flag"""
+        self._clearLabels()
+        labels = self._labels
+        sources = set(pair[0] for pair in self._links.keys())
+        targets = set(pair[1] for pair in self._links.keys())
+        # start with the values that nothing links to, for larger trees
+        roots = sorted(sources - targets) + sorted(sources & targets)
+        for root in roots:
+            if root in labels:
+                continue
+            labels[root] = (self._next, None)
+            self._next += 1
+            stack = [(root, self._successors(root))]
+            while stack:
+                token, successors = stack[-1]
+                for successor in successors:
+                    if successor in labels:
+                        self._addExtraLink(token, successor)
+                    else:
+                        self._treeLinks.insert((token, successor))
+                        labels[successor] = (self._next, None)
+                        self._next += 1
+                        stack.append(
+                            (successor, self._successors(successor)))
+                        break
+                else:
+                    stack.pop()
+                    labels[token] = (labels[token][0], self._next - 1)
+
+    def isReachable(self, token1, token2):
+        """whether a chain of one or more relationships leads from token1
+        to token2, or None if the labels are stale."""
+        if self.stale:
+            return None
+        labels = self._labels
+        if token1 not in labels or token2 not in labels:
+            return False
+        target = labels[token2][0]
+        if token1 == token2:
+            stack = [labels[t] for t in self._successors(token1)]
+        else:
+            stack = [labels[token1]]
+        seen = set()
+        while stack:
+            first, last = stack.pop()
+            if first <= target <= last:
+                return True
+            if first in seen:
+                continue
+            seen.add(first)
+            for targets in self._extraLinks.values(first, last):
+                stack.extend(labels[t] for t in targets)
+        return False
+
+    def _index(self, catalog):
+        super()._index(catalog)
+        self.relabel()
+
+    def _add(self, relToken, pairs):
+        for pair in pairs:
+            count = self._links.get(pair, 0)
+            self._links[pair] = count + 1
+            if not count:
+                self._label(pair[1])
+                self._addExtraLink(*pair)
+
+    def _remove(self, relToken, pairs):
+        for pair in pairs:
+            count = self._links[pair] - 1
+            if count:
+                self._links[pair] = count
+                continue
+            del self._links[pair]
+            if pair in self._treeLinks:
+                self._treeLinks.remove(pair)
+                self.stale = True
+            else:
+                first = self._labels[pair[0]][0]
+                targets = self._extraLinks[first]
+                targets.remove(pair[1])
+                self.extraLinks -= 1
+                if not targets:
+                    del self._extraLinks[first]
+
+    def _clear(self):
+        self._links.clear()
+        self._clearLabels()
+
+##############################################################################
+# an optional estimate of how many values each value can reach
+
+
+def _hashToken(token):
+    # a 64 bit hash of an integer token that is the same in every process
+    return int.from_bytes(hashlib.blake2b(
+        token.to_bytes(8, 'big', signed=True), digest_size=8).digest(), 'big')
+
+
+def _sketchAdd(sketch, token, precision):
+    # a HyperLogLog sketch, as bytes of 2 ** precision registers, that also
+    # counts the token.  `sketch` may be None, for an empty sketch.
+    h = _hashToken(token)
+    bits = 64 - precision
+    register = h >> bits
+    rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+    if sketch is None:
+        sketch = bytes(1 << precision)
+    elif sketch[register] >= rank:
+        return sketch
+    sketch = bytearray(sketch)
+    sketch[register] = rank
+    return bytes(sketch)
+
+
+def _sketchMerge(sketch1, sketch2):
+    return bytes(map(max, sketch1, sketch2))
+
+
+def _sketchEstimate(sketch):
+    m = len(sketch)
+    res = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in sketch)
+    zeros = sketch.count(0)
+    if zeros and res <= 2.5 * m:
+        res = m * math.log(m / zeros)  # linear counting, for small sets
+    return int(round(res))
+
+
+@interface.implementer(zc.relation.interfaces.IListener)
+class ReachEstimator(_PairListener):
+    """Estimates how many values each value token can reach.
+
+    Relationships link each of their `name1` values to each of their `name2`
+    values, which must share integer tokens, such as intids, so that each
+    value hashes the same way in every process.  For each value that links
+    to others, the estimator keeps a HyperLogLog sketch of the values it can
+    reach through chains of any length: 2 ** `precision` bytes, from which
+    ``estimateReach`` computes an estimate in constant time.  The relative
+    standard error is about 1.04 / sqrt(2 ** precision), or 6.5% for the
+    default precision of 8; small counts are usually exact.
+
+    Install it as a listener of an index (``index.addListener(estimator)``).
+    An added link merges into the sketches of the values that reach it.
+    Sketches cannot forget values, so removing a link leaves the estimates
+    too high, and sets `stale`.  Call ``rebuild`` from time to time, such as
+    when `stale` is true, to compute the sketches again.
+    """
+
+    def __init__(self, name1, name2, precision=8):
+        if not isinstance(precision, int) or not 7 <= precision <= 16:
+            raise ValueError('invalid precision', precision)
+        super().__init__(name1, name2)
+        self.precision = precision
+        self._links = BTrees.family32.OO.BTree()  # pair: number of rels
+        self._reversed = BTrees.family32.OO.TreeSet()  # (token2, token1)
+        self._sketches = BTrees.family32.OO.BTree()
+        self.stale = False
+
+    def estimateReach(self, token):
+        """estimate the number of values that token can reach"""
+        sketch = self._sketches.get(token)
+        if sketch is None:
+            return 0
+        return _sketchEstimate(sketch)
+
+    def _successors(self, token):
+        for token1, token2 in self._links.keys(min=(token,)):
+            if token1 != token:
+                break
+            yield token2
+
+    def _predecessors(self, token):
+        for token2, token1 in self._reversed.keys(min=(token,)):
+            if token2 != token:
+                break
+            yield token1
+
+    def rebuild(self):
+        """compute the sketches again, and clear the `stale` flag"""
+        self._sketches.clear()
+        self.stale = False
+        sketches = self._sketches
+        precision = self.precision
+        # Tarjan's algorithm finds the strongly connected components after
+        # all of those that they reach, so each component's sketch merges
+        # finished sketches.  The values of a component reach one another.
+        indexes = {}
+        lowlinks = {}
+        stack = []
+        for root in set(pair[0] for pair in self._links.keys()):
+            if root in indexes:
+                continue
+            indexes[root] = lowlinks[root] = len(indexes)
+            stack.append(root)
+            path = [(root, self._successors(root))]
+            while path:
+                token, successors = path[-1]
+                for successor in successors:
+                    if successor not in indexes:
+                        indexes[successor] = lowlinks[successor] = len(indexes)
+                        stack.append(successor)
+                        path.append((successor, self._successors(successor)))
+                        break
+                    elif successor in lowlinks:
+                        lowlinks[token] = min(
+                            lowlinks[token], indexes[successor])
+                else:
+                    path.pop()
+                    lowlink = lowlinks[token]
+                    if path:
+                        parent = path[-1][0]
+                        lowlinks[parent] = min(lowlinks[parent], lowlink)
+                    if lowlink != indexes[token]:
+                        continue
+                    component = []
+                    while True:
+                        value = stack.pop()
+                        del lowlinks[value]
+                        component.append(value)
+                        if value == token:
+                            break
+                    members = set(component)
+                    sketch = None
+                    for value in component:
+                        for successor in self._successors(value):
+                            found = sketch
+                            if successor not in members:
+                                found = sketches.get(successor)
+                                if found is not None and sketch is not None:
+                                    found = _sketchMerge(found, sketch)
+                                elif found is None:
+                                    found = sketch
+                            sketch = _sketchAdd(found, successor, precision)
+                    if sketch is not None:
+                        for value in component:
+                            sketches[value] = sketch
+
+    def _index(self, catalog):
+        for name in self.names:
+            prefix = catalog.getValueModuleTools(name)['TreeSet'].__name__[0]
+            if prefix not in ('I', 'L'):
+                raise ValueError('integer value tokens are required', name)
+        for relToken, pairs in self._iterPairs(catalog):
+            for pair in pairs:
+                self._link(pair)
+        self.rebuild()
+
+    def _link(self, pair):
+        count = self._links.get(pair, 0)
+        self._links[pair] = count + 1
+        if not count:
+            self._reversed.insert((pair[1], pair[0]))
+        return not count
+
+    def _add(self, relToken, pairs):
+        precision = self.precision
+        for token1, token2 in pairs:
+            if not self._link((token1, token2)):
+                continue
+            # token1, and every value that reaches it, now reaches token2 and
+            # every value that token2 reaches
+            stack = [(token1, _sketchAdd(
+                self._sketches.get(token2), token2, precision))]
+            while stack:
+                token, sketch = stack.pop()
+                old = self._sketches.get(token)
+                if old is not None:
+                    sketch = _sketchMerge(old, sketch)
+                    if sketch == old:
+                        continue
+                self._sketches[token] = sketch
+                sketch = _sketchAdd(sketch, token, precision)
+                stack.extend(
+                    (value, sketch) for value in self._predecessors(token))
+
+    def _remove(self, relToken, pairs):
+        for pair in pairs:
+            count = self._links[pair] - 1
+            if count:
+                self._links[pair] = count
+            else:
+                del self._links[pair]
+                self._reversed.remove((pair[1], pair[0]))
+                self.stale = True
+
+    def _clear(self):
+        self._links.clear()
+        self._reversed.clear()
+        self._sketches.clear()
+        self.stale = False
+
+    def sourceCopied(self, original, copy):
+        copy.addListener(self.__class__(*self.names, self.precision))
+
+##############################################################################
+# an optional index of the sort keys of values
+
+
+def _resolveValue(catalog, token, name):
+    for value in catalog.resolveValueTokens((token,), name):
+        return value
+
+
+@interface.implementer(zc.relation.interfaces.IListener)
+class SortIndex(persistent.Persistent):
+    """Keeps a sort key for each value of the `names` value indexes, so that
+    search results can be ordered without loading them.
+
+    `key` is called with a value when the first relationship that has it is
+    indexed, and returns its sort key, or None for no key.  It must be
+    picklable, such as a function of a module, and the keys must be
+    comparable with one another.  ``updateKey`` computes the key of a value
+    again, for keys that change.
+
+    Install it as a listener of an index (``index.addListener(sortIndex)``);
+    it then keeps itself up-to-date as relationships are indexed and
+    unindexed, dropping the keys of values that no relationship has.
+    ``sortTokens`` orders value tokens by their keys.
+    """
+
+    catalog = None
+
+    def __init__(self, name, key, names=('source', 'target')):
+        self.name = name
+        self.key = key
+        self.names = tuple(names)
+        self._keys = BTrees.family32.OO.BTree()  # token: key
+        self._order = BTrees.family32.OO.TreeSet()  # (key, token)
+        self._length = BTrees.Length.Length()  # of _order
+
+    def getKey(self, token):
+        """return the sort key of the value token, or None"""
+        return self._keys.get(token)
+
+    def updateKey(self, token):
+        """compute the sort key of the value token again"""
+        for name in self.names:
+            if token in self.catalog.getValueTokens(name):
+                self._setKey(token, self.key(
+                    _resolveValue(self.catalog, token, name)))
+                return
+
+    def sortTokens(self, tokens, limit=None, reverse=False):
+        """return a list of the value tokens in the order of their keys.
+
+        Values with no key come last, in token order.  If `limit` is given,
+        only that many tokens are returned.  The first tokens are found
+        with a heap of the keys of the given tokens or, if that looks
+        cheaper, by walking the sorted keys until enough are found.
+        """
+        if limit is not None and (not isinstance(limit, int) or limit < 0):
+            raise ValueError('invalid limit', limit)
+        if not isinstance(tokens, (set, frozenset)):
+            tokens = set(tokens)
+        if limit is not None and limit * self._length.value < len(
+                tokens) ** 2:
+            # with keys spread evenly, a walk of about
+            # limit * len(_order) / len(tokens) keys finds enough
+            keys = self._order.keys()
+            if reverse:
+                keys = reversed(keys)
+            res = []
+            for key, token in keys:
+                if len(res) >= limit:
+                    return res
+                if token in tokens:
+                    res.append(token)
+            keyed = res
+            unkeyed = sorted(
+                token for token in tokens if self._keys.get(token) is None)
+        else:
+            keyed = []
+            unkeyed = []
+            for token in tokens:
+                key = self._keys.get(token)
+                if key is None:
+                    unkeyed.append(token)
+                else:
+                    keyed.append((key, token))
+            if limit is None:
+                keyed.sort(reverse=reverse)
+            elif reverse:
+                keyed = heapq.nlargest(limit, keyed)
+            else:
+                keyed = heapq.nsmallest(limit, keyed)
+            keyed = [token for key, token in keyed]
+            unkeyed.sort()
+        res = keyed + unkeyed
+        if limit is not None:
+            del res[limit:]
+        return res
+
+    def _setKey(self, token, key):
+        if token in self._keys:
+            self._discard(token)
+        self._keys[token] = key
+        if key is not None:
+            self._order.insert((key, token))
+            self._length.change(1)
+
+    def _discard(self, token):
+        key = self._keys.pop(token)
+        if key is not None:
+            self._order.remove((key, token))
+            self._length.change(-1)
+
+    def _add(self, catalog, tokens, name):
+        for token in tokens or ():
+            if token not in self._keys:
+                self._setKey(
+                    token, self.key(_resolveValue(catalog, token, name)))
+
+    def _remove(self, catalog, tokens):
+        for token in tokens or ():
+            if token in self._keys and not [
+                    nm for nm in self.names
+                    if token in catalog.getValueTokens(nm)]:
+                self._discard(token)
+
+    def _clear(self):
+        self._keys.clear()
+        self._order.clear()
+        self._length.set(0)
+
+    # IListener
+
+    def relationAdded(self, token, catalog, additions):
+        for name in self.names:
+            self._add(catalog, additions.get(name), name)
+
+    def relationModified(self, token, catalog, additions, removals):
+        for name in self.names:
+            self._add(catalog, additions.get(name), name)
+            self._remove(catalog, removals.get(name))
+
+    def relationRemoved(self, token, catalog, removals):
+        for name in self.names:
+            self._remove(catalog, removals.get(name))
+
+    def sourceCleared(self, catalog):
+        self._clear()
+
+    def sourceAdded(self, catalog):
+        self.catalog = catalog
+        for name in self.names:
+            self._add(catalog, catalog.getValueTokens(name), name)
+
+    def sourceRemoved(self, catalog):
+        self.catalog = None
+        self._clear()
+
+    def sourceCopied(self, original, copy):
+        copy.addListener(self.__class__(self.name, self.key, self.names))
+
+##############################################################################
+# an optional log of the changes to an index
+
+
+@interface.implementer(zc.relation.interfaces.IListener)
+class ChangeLog(persistent.Persistent):
+    """An ordered log of the changes to an index, one entry per transaction.
+
+    Install it as a listener of an index (``index.addListener(log)``).  When
+    a transaction that changed the index commits, the log appends an entry
+    with the next sequence number and a tuple of the transaction's
+    ``(relationship token, name, added value tokens, removed value tokens)``
+    deltas, in the order they happened.  A delta with a relationship token
+    and name of None records that the index was cleared.
+
+    ``iterChanges(after)`` yields the ``(sequence, deltas)`` entries after a
+    sequence number, so a consumer can remember the last sequence it saw and
+    read only what is new; ``truncate(upTo)`` discards the entries that all
+    consumers have read.  Transactions that change the index also change the
+    log, so they are serialized by conflict errors.  The deltas of a
+    transaction are kept in a persistent list until it commits, so that a
+    savepoint rollback undoes them along with the changes to the index.
+    """
+
+    catalog = None
+    _lastSequence = 0
+    _pending = None  # the deltas of the current transaction
+
+    def __init__(self):
+        self._entries = BTrees.family64.IO.BTree()
+
+    def _getTransaction(self):
+        # the transaction of the connection of the log, or of its index if
+        # the log is new, which may have its own transaction manager
+        for ob in (self, self.catalog):
+            jar = getattr(ob, '_p_jar', None)
+            if jar is not None:
+                return jar.transaction_manager.get()
+        return transaction.get()
+
+    def _getBuffer(self):
+        txn = self._getTransaction()
+        try:
+            txn.data(self)
+        except KeyError:
+            txn.set_data(self, True)
+            txn.addBeforeCommitHook(self._append)
+        if self._pending is None:
+            self._pending = persistent.list.PersistentList()
+        return self._pending
+
+    def _append(self):
+        buffer = self._pending
+        if buffer:
+            self._lastSequence += 1
+            self._entries[self._lastSequence] = tuple(buffer)
+            del buffer[:]
+
+    def _record(self, token, additions, removals):
+        buffer = self._getBuffer()
+        for name in sorted(set(additions).union(removals)):
+            added = tuple(additions.get(name) or ())
+            removed = tuple(removals.get(name) or ())
+            if added or removed:
+                buffer.append((token, name, added, removed))
+
+    def getLastSequence(self):
+        """return the sequence number of the last entry, or 0"""
+        return self._lastSequence
+
+    def iterChanges(self, after=0):
+        """yield the (sequence, deltas) entries after the given sequence"""
+        return iter(self._entries.items(min=after, excludemin=True))
+
+    def truncate(self, upTo):
+        """discard the entries up to and including the given sequence"""
+        for sequence in list(self._entries.keys(max=upTo)):
+            del self._entries[sequence]
+
+    # IListener
+
+    def relationAdded(self, token, catalog, additions):
+        self._record(token, additions, {})
+
+    def relationModified(self, token, catalog, additions, removals):
+        self._record(token, additions, removals)
+
+    def relationRemoved(self, token, catalog, removals):
+        self._record(token, {}, removals)
+
+    def sourceCleared(self, catalog):
+        self._getBuffer().append((None, None, (), ()))
+
+    def sourceAdded(self, catalog):
+        self.catalog = catalog
+
+    def sourceRemoved(self, catalog):
+        self.catalog = None
+
+    def sourceCopied(self, original, copy):
+        copy.addListener(self.__class__())
+
+##############################################################################
+# strongly connected components of the graph of two indexed values
+
+
+def _getCounterMapping(tools):
+    # a compact mapping of tokens to integers
+    prefix = tools['TreeSet'].__name__[0]
+    if prefix == 'I':
+        return BTrees.family32.II.BTree()
+    elif prefix == 'L':
+        return BTrees.family64.II.BTree()
+    else:
+        return BTrees.family32.OI.BTree()
+
+
+def iterStronglyConnectedComponents(catalog, name1, name2):
+    """iterate over the cycles of the graph in which relationships point
+    from their name1 values to their name2 values.
+
+    Yields a (value token set, relationship token set) pair for each strongly
+    connected component that has a cycle: the values that can all reach one
+    another, and the relationships that close the cycles among them.  A
+    relationship from a value to itself is a cycle.
+
+    This is Tarjan's algorithm, iterative, over the index postings.  Each
+    relationship and each of its values is visited once, and the bookkeeping
+    is kept in BTrees."""
+    valueTools = catalog.getValueModuleTools(name1)
+    relTools = catalog.getRelationModuleTools()
+    postings = catalog.getValueTokens(name1)
+    # values and relationships are both nodes of the graph.  Their tokens may
+    # overlap, so each has its own mappings, indexed by whether the node is a
+    # relationship.
+    indexes = (_getCounterMapping(valueTools), _getCounterMapping(relTools))
+    # a node has a lowlink only while it is on the component stack
+    lowlinks = (_getCounterMapping(valueTools), _getCounterMapping(relTools))
+
+    def successors(isRel, token):
+        if isRel:
+            return iter(catalog.getValueTokens(name2, token) or ())
+        data = postings.get(token)
+        if data is None:
+            return iter(())
+        return iter(data[1])
+
+    counter = 0
+    stack = []
+    for root in postings:
+        if root in indexes[False]:
+            continue
+        indexes[False][root] = lowlinks[False][root] = counter
+        counter += 1
+        stack.append((False, root))
+        path = [(False, root, successors(False, root))]
+        while path:
+            isRel, token, children = path[-1]
+            childIsRel = not isRel
+            for child in children:
+                if child not in indexes[childIsRel]:
+                    indexes[childIsRel][child] = counter
+                    lowlinks[childIsRel][child] = counter
+                    counter += 1
+                    stack.append((childIsRel, child))
+                    path.append(
+                        (childIsRel, child, successors(childIsRel, child)))
+                    break
+                elif child in lowlinks[childIsRel]:
+                    childIndex = indexes[childIsRel][child]
+                    if childIndex < lowlinks[isRel][token]:
+                        lowlinks[isRel][token] = childIndex
+            else:
+                path.pop()
+                lowlink = lowlinks[isRel][token]
+                if path:
+                    parentIsRel, parent, _ = path[-1]
+                    if lowlink < lowlinks[parentIsRel][parent]:
+                        lowlinks[parentIsRel][parent] = lowlink
+                if lowlink == indexes[isRel][token]:
+                    values = valueTools['TreeSet']()
+                    rels = relTools['TreeSet']()
+                    while True:
+                        nodeIsRel, node = stack.pop()
+                        del lowlinks[nodeIsRel][node]
+                        if nodeIsRel:
+                            rels.insert(node)
+                        else:
+                            values.insert(node)
+                        if nodeIsRel == isRel and node == token:
+                            break
+                    if values and rels:  # otherwise it is a lone node
+                        yield values, rels
+
+##############################################################################
+# loading index data into the ZODB cache ahead of use
+
+
+class _WarmUp:
+    # loads persistent objects, and counts the estimated memory of those that
+    # were ghosts, until a budget is spent
+
+    def __init__(self, maxBytes):
+        if maxBytes is not None and (
+                not isinstance(maxBytes, int) or maxBytes < 1):
+            raise ValueError('invalid maxBytes', maxBytes)
+        self.maxBytes = maxBytes
+        self.objects = 0
+        self.bytes = 0
+
+    @property
+    def full(self):
+        return self.maxBytes is not None and self.bytes >= self.maxBytes
+
+    def load(self, ob):
+        if self.full:
+            return False
+        if isinstance(ob, persistent.Persistent) and ob._p_changed is None:
+            ob._p_activate()
+            self.objects += 1
+            self.bytes += ob._p_estimated_size
+        return True
+
+    def loadTree(self, tree):
+        # load a BTree or TreeSet a level at a time, from the top
+        level = [tree]
+        while level:
+            children = []
+            for node in level:
+                if not self.load(node):
+                    return False
+                if isinstance(node, type(tree)):
+                    state = node.__getstate__()
+                    if state is not None and len(state) > 1:
+                        children.extend(state[0][::2])
+            level = children
+        return True
+
+##############################################################################
+# merging large results
+
+
+def _chunkedMultiunion(iterable, tools, chunkSize=1000):
+    # merge an iterable of tokens and token sets into a TreeSet, a chunk at a
+    # time, so that the items are never all held in memory at once.
+    res = tools['TreeSet']()
+    iterator = iter(iterable)
+    while True:
+        chunk = tuple(itertools.islice(iterator, chunkSize))
+        if not chunk:
+            return res
+        res.update(tools['multiunion'](chunk))
 
 ##############################################################################
 # the relationship index
@@ -110,15 +1141,17 @@ def resolveToken(token, index, cache):
 
 @interface.implementer_only(
     interfaces.IIndex, interface.implementedBy(persistent.Persistent),
-    interface.implementedBy(zope.app.container.contained.Contained)
+    zope.location.interfaces.IContained
 )
-class Index(zc.relation.catalog.Catalog,
-            zope.app.container.contained.Contained):
+class Index(zc.relation.catalog.Catalog):
+
+    __parent__ = __name__ = None
 
     def __init__(self, attrs, defaultTransitiveQueriesFactory=None,
                  dumpRel=generateToken, loadRel=resolveToken,
                  relFamily=None, family=None, deactivateSets=False):
         super().__init__(dumpRel, loadRel, relFamily, family)
+        self._generation = BTrees.Length.Length()
         self.defaultTransitiveQueriesFactory = defaultTransitiveQueriesFactory
         for data in attrs:
             if zope.interface.interfaces.IElement.providedBy(data):
@@ -137,6 +1170,68 @@ class Index(zc.relation.catalog.Catalog,
             self.addValueIndex(**data)
         # deactivateSets is now ignored.  It was broken before.
 
+    def tokenizeValues(self, values, name):
+        if self._attrs[name]['dump'] is generateToken:
+            return generateTokens(values, self, {})
+        return super().tokenizeValues(values, name)
+
+    def tokenizeQueries(self, queries):
+        """return a list of the tokenized queries, as tokenizeQuery would
+        tokenize each.
+
+        The values of all the names that share a dump are dumped together,
+        sharing a cache, and those dumped with generateToken are looked up
+        once for each distinct object."""
+        queries = [dict(query) for query in queries]
+        values = {}  # dump: values, in the order of the queries
+        for query in queries:
+            for name, value in query.items():
+                dump = self._getDump(name)
+                if dump is None or value is None:
+                    continue
+                if isinstance(value, zc.relation.catalog.Any):
+                    values.setdefault(dump, []).extend(value)
+                else:
+                    values.setdefault(dump, []).append(value)
+        tokens = {}
+        for dump, objs in values.items():
+            cache = {}
+            if dump is generateToken:
+                tokens[dump] = iter(generateTokens(objs, self, cache))
+            else:
+                tokens[dump] = iter([dump(o, self, cache) for o in objs])
+        for query in queries:
+            for name, value in query.items():
+                dump = self._getDump(name)
+                if dump is None or value is None:
+                    continue
+                if isinstance(value, zc.relation.catalog.Any):
+                    query[name] = zc.relation.catalog.Any(
+                        [next(tokens[dump]) for o in value])
+                else:
+                    query[name] = next(tokens[dump])
+        return queries
+
+    def _getDump(self, name):
+        if name is zc.relation.catalog.RELATION:
+            return self._relTools['dump']
+        return self._attrs[name]['dump']
+
+    def tokenizeRelations(self, rels):
+        if self._relTools['dump'] is generateToken:
+            return generateTokens(rels, self, {})
+        return super().tokenizeRelations(rels)
+
+    def _queryValueToken(self, value, name):
+        # the token of a value; unlike dumping it, this does not give a value
+        # that has no intid one, but returns None
+        dump = self._attrs[name]['dump']
+        if dump is None:
+            return value
+        elif dump is generateToken:
+            return _getIntIds({}).queryId(value)
+        return dump(value, self, {})
+
     # disable zc.relation default query factories, enable zc.relationship
     addDefaultQueryFactory = iterDefaultQueryFactories = None
     removeDefaultQueryFactory = None
@@ -149,6 +1244,409 @@ class Index(zc.relation.catalog.Catalog,
             res = factoryWrapper(queryFactory, query, self)
         return queryFactory, res
 
+    def yieldRelationTokenChains(self, query, relData, maxDepth, checkFilter,
+                                 checkTargetFilter, getQueries,
+                                 findCycles=True):
+        transposition = getattr(getQueries, 'transposition', None)
+        if transposition is None:
+            return super().yieldRelationTokenChains(
+                query, relData, maxDepth, checkFilter, checkTargetFilter,
+                getQueries, findCycles)
+        return self._yieldTransposedTokenChains(
+            query, relData, maxDepth, checkFilter, checkTargetFilter,
+            transposition, findCycles)
+
+    def _yieldTransposedTokenChains(self, query, relData, maxDepth,
+                                    checkFilter, checkTargetFilter,
+                                    transposition, findCycles):
+        # the same walk as zc.relation's yieldRelationTokenChains, but reading
+        # the postings of the transposed name directly rather than building
+        # and parsing a query for every value of every relationship.
+        queryName, valueName = transposition
+        postings = self._name_TO_mapping[queryName]
+        valueSets = self._reltoken_name_TO_objtokenset
+        relTools = self._relTools
+        stack = collections.deque(((), iter(d)) for d in relData)
+        while stack:
+            tokenChain, relDataIter = stack[0]
+            relToken = next(relDataIter, _marker)
+            if relToken is _marker:
+                stack.popleft()
+                continue
+            tokenChain += (relToken,)
+            if checkFilter is not None and not checkFilter(tokenChain, query):
+                continue
+            walkFurther = maxDepth is None or len(tokenChain) < maxDepth
+            if walkFurther or findCycles:
+                if valueName is None:
+                    tokens = (relToken,)
+                else:
+                    tokens = valueSets.get((relToken, valueName)) or ()
+                nextSets = []
+                cycled = None
+                for token in tokens:
+                    data = postings.get(token)
+                    if data is None or not data[0].value:
+                        continue
+                    rels = data[1]
+                    for t in tokenChain:
+                        if t in rels:
+                            # it's a cycle
+                            if cycled is None:
+                                cycled = []
+                            cycled.append({queryName: token})
+                            break
+                    else:
+                        if walkFurther:
+                            nextSets.append(rels)
+                if walkFurther and nextSets:
+                    # a set of the relationship family, not a Python set,
+                    # for each chain waiting in the stack
+                    stack.append((tokenChain, iter(
+                        zc.relation.catalog.multiunion(nextSets, relTools))))
+                if cycled:
+                    tokenChain = CircularRelationshipPath(tokenChain, cycled)
+            if (checkTargetFilter is None or
+                    checkTargetFilter(tokenChain, query)):
+                yield tokenChain
+
+    def _yieldValueTokens(
+            self, name, query, relData, maxDepth, checkFilter,
+            checkTargetFilter, getQueries, yieldSets=False):
+        # as in zc.relation, but remembering the tokens seen in sets of the
+        # index's own BTree families rather than in Python sets.
+        relSeen = self._relTools['TreeSet']()
+        objSeen = self._attrs[name]['TreeSet']()
+        for path in self.yieldRelationTokenChains(
+                query, relData, maxDepth, checkFilter, checkTargetFilter,
+                getQueries, findCycles=False):
+            relToken = path[-1]
+            if relSeen.insert(relToken):
+                outputSet = self._reltoken_name_TO_objtokenset.get(
+                    (relToken, name))
+                if outputSet:
+                    if yieldSets:
+                        yield outputSet
+                    else:
+                        for token in outputSet:
+                            if objSeen.insert(token):
+                                yield token
+
+    def _findReachableValueTokens(self, resultName, query, maxDepth, filter,
+                                  targetQuery, targetFilter,
+                                  transitiveQueriesFactory):
+        # findValueTokens without relationship chains: a breadth-first search
+        # over sets of relationship tokens.
+        if filter is not None or targetFilter is not None or targetQuery:
+            raise ValueError(
+                'keepChains=False cannot be used with filter, targetQuery '
+                'or targetFilter')
+        query = BTrees.family32.OO.Bucket(query)
+        queryFactory, getQueries = self._getQueryFactory(
+            query, transitiveQueriesFactory)
+        transposition = getattr(getQueries, 'transposition', None)
+        if transposition is None:
+            raise ValueError(
+                'keepChains=False requires a TransposingTransitiveQueries'
+                'Factory and a query on one of its names')
+        relData = self._parse(
+            query, maxDepth, None, BTrees.family32.OO.Bucket(), None,
+            getQueries)[1]
+        return self._yieldReachableValueTokens(
+            resultName, relData, maxDepth, transposition)
+
+    def _yieldReachableValueTokens(self, name, relData, maxDepth,
+                                   transposition):
+        queryName, valueName = transposition
+        postings = self._name_TO_mapping[queryName]
+        valueSets = self._reltoken_name_TO_objtokenset
+        relTools = self._relTools
+        valueTools = self._attrs[valueName] if valueName is not None else None
+        relSeen = relTools['TreeSet']()
+        tokenSeen = (valueTools or relTools)['TreeSet']()
+        objSeen = self._attrs[name]['TreeSet']()
+        multiunion = zc.relation.catalog.multiunion
+        rels = multiunion(relData, relTools)
+        depth = 1
+        while True:
+            rels = relTools['difference'](rels, relSeen)
+            if not rels:
+                break
+            relSeen.update(rels)
+            for relToken in rels:
+                outputSet = valueSets.get((relToken, name))
+                if outputSet:
+                    for token in outputSet:
+                        if objSeen.insert(token):
+                            yield token
+            if maxDepth is not None and depth >= maxDepth:
+                break
+            depth += 1
+            if valueName is None:
+                tokens = rels
+            else:
+                tokens = multiunion(
+                    (valueSets.get((r, valueName)) for r in rels),
+                    valueTools)
+            tokens = (valueTools or relTools)['difference'](tokens, tokenSeen)
+            tokenSeen.update(tokens)
+            rels = multiunion(
+                (postings.get(t, (None, None))[1] for t in tokens), relTools)
+
+    # an optional volatile cache of search results, for repeated searches
+    # within a connection.  Set queryCacheSize to the maximum number of
+    # results to keep (least recently used results are discarded first).
+    # The cache is discarded whenever relationships are indexed or
+    # unindexed, here or in another connection, and it is not used while
+    # the index has changes that are not committed.  Lazy results are only
+    # cached if they have no more than queryCacheItemLimit items; a longer
+    # one is handed out as it is read, so that neither the search nor the
+    # cache has to hold all of it.
+
+    queryCacheSize = 0
+    queryCacheItemLimit = 1000
+    _generation = None  # instances from before the cache have none
+
+    def _changed(self):
+        if self._generation is None:
+            self._generation = BTrees.Length.Length()
+        self._generation.change(1)
+
+    def index_doc(self, relToken, rel):
+        super().index_doc(relToken, rel)
+        self._changed()
+
+    def unindex_doc(self, relToken):
+        super().unindex_doc(relToken)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def _getQueryCache(self):
+        # the cache for the committed state of the index, or None if the
+        # index has uncommitted changes.  An abort or a savepoint rollback
+        # would take the generation back with them, and the next change
+        # would then give a different state the same generation; so the
+        # cache is keyed by the generation and the serial of its commit.
+        generation = self._generation
+        if generation is None:
+            key = None
+        else:
+            key = (generation.value, generation._p_serial)
+            if generation._p_changed:
+                return None
+        cache = getattr(self, '_v_queryCache', None)
+        if cache is None or cache[0] != key:
+            cache = self._v_queryCache = (key, collections.OrderedDict())
+        return cache[1]
+
+    def _cached(self, key, search):
+        if not self.queryCacheSize:
+            return search()
+        try:
+            hash(key)
+        except TypeError:  # such as a query with zc.relation.catalog.any
+            return search()
+        cache = self._getQueryCache()
+        if cache is None:
+            return search()
+        entry = cache.get(key)
+        if entry is None:
+            res = search()
+            isIterator = isinstance(res, types.GeneratorType)
+            if isIterator:
+                limit = self.queryCacheItemLimit
+                head = tuple(itertools.islice(res, limit + 1))
+                if len(head) > limit:
+                    return itertools.chain(head, res)
+                res = head
+            entry = cache[key] = (res, isIterator)
+            while len(cache) > self.queryCacheSize:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        res, isIterator = entry
+        if isIterator:
+            return iter(res)
+        return res
+
+    def _getCacheKey(self, kind, query, maxDepth, filter, targetQuery,
+                     targetFilter, transitiveQueriesFactory):
+        return (kind,
+                tuple(BTrees.family32.OO.Bucket(query or ()).items()),
+                maxDepth, filter,
+                tuple(BTrees.family32.OO.Bucket(targetQuery).items()),
+                targetFilter, transitiveQueriesFactory)
+
+    def warmUp(self, maxBytes=None):
+        # load the structures that searches use into the ZODB cache, in order
+        # of usefulness: the BTrees of relationships, postings and values;
+        # the postings, largest first; the value sets of the relationships;
+        # and the intid mapping used to resolve tokens.
+        warm = _WarmUp(maxBytes)
+        names = [info['name'] for info in self.iterValueIndexInfo()]
+        trees = [self._relTokens]
+        trees.extend(self._name_TO_mapping[name] for name in names)
+        trees.append(self._reltoken_name_TO_objtokenset)
+        if not warm.load(self) or not all(
+                warm.loadTree(tree) for tree in trees):
+            return warm.objects, warm.bytes
+        postings = []
+        for name in names:
+            for token, (length, rels) in self._name_TO_mapping[name].items():
+                if not warm.load(length):
+                    return warm.objects, warm.bytes
+                postings.append((length.value, rels))
+        postings.sort(key=lambda posting: -posting[0])
+        sets = [rels for size, rels in postings]
+        sets.extend(tokens for tokens in
+                    self._reltoken_name_TO_objtokenset.values()
+                    if tokens is not None)
+        if not all(warm.loadTree(tree) for tree in sets):
+            return warm.objects, warm.bytes
+        loads = [info['load'] for info in self.iterValueIndexInfo()]
+        loads.append(self._relTools['load'])
+        if resolveToken in loads:
+            try:
+                intids = component.queryUtility(
+                    _getIntIdsInterface(), context=self)
+            except component.ComponentLookupError:  # not in a site
+                intids = None
+            if intids is not None:
+                warm.load(intids)
+                warm.loadTree(intids.refs)
+        return warm.objects, warm.bytes
+
+    # consistency checks, for the containers' verify method.  Each looks at
+    # a single relationship or posting, so that a large index can be checked
+    # in many small transactions.
+
+    def _queryRelationToken(self, rel):
+        # the token of a relationship; unlike dumping it, this does not give
+        # a relationship that has no intid one, but returns None
+        dump = self._relTools['dump']
+        if dump is generateToken:
+            return _getIntIds({}).queryId(rel)
+        return dump(rel, self, {})
+
+    def _queryValueTokens(self, rel, data):
+        # the intids of the values of rel for a value index dumped with
+        # generateToken, as _getValuesAndTokens finds them, but without
+        # registering any: _marker if a value has none
+        if 'interface' in data:
+            values = None
+            valueSource = data['interface'](rel, None)
+            if valueSource is not None:
+                values = getattr(valueSource, data['attrname'])
+                if data['call']:
+                    values = values()
+        else:
+            values = data['callable'](rel, self)
+        if not data['multiple'] and values is not None:
+            values = (values,)
+        if not values:
+            return None
+        intids = _getIntIds({})
+        tokens = [intids.queryId(value) for value in values]
+        if None in tokens:
+            return _marker
+        return data['TreeSet'](tokens)
+
+    def _checkRelationToken(self, relToken, rel, register=True):
+        # return the names of the value indexes whose data for relToken do not
+        # match rel, or None if relToken is not indexed at all.  Unless
+        # register is true, values that have no intid are not given one, but
+        # make their value index not match.
+        if relToken not in self._relTokens:
+            return None
+        res = []
+        for data in self._attrs.values():
+            name = data['name']
+            if register or data['dump'] is not generateToken:
+                values, tokens, optimization = self._getValuesAndTokens(
+                    rel, data)
+            else:
+                tokens = self._queryValueTokens(rel, data)
+                if tokens is _marker:
+                    res.append(name)
+                    continue
+            old = self._reltoken_name_TO_objtokenset.get(
+                (relToken, name), _marker)
+            if old is _marker or list(old or ()) != list(tokens or ()):
+                res.append(name)
+                continue
+            if old is None:
+                dataset = self._EMPTY_name_TO_relcount_relset
+                keys = (name,)
+            else:
+                dataset = self._name_TO_mapping[name]
+                keys = old
+            for key in keys:
+                posting = dataset.get(key)
+                if posting is None or relToken not in posting[1]:
+                    res.append(name)
+                    break
+        return res
+
+    def _discard(self, relToken, tokens, name):
+        # like _remove, but tolerates missing postings
+        if tokens is None:
+            dataset = self._EMPTY_name_TO_relcount_relset
+            keys = (name,)
+        else:
+            dataset = self._name_TO_mapping[name]
+            keys = tokens
+        for key in keys:
+            posting = dataset.get(key)
+            if posting is not None and relToken in posting[1]:
+                posting[1].remove(relToken)
+                posting[0].change(-1)
+                if not posting[1]:
+                    del dataset[key]
+
+    def _forgetRelationToken(self, relToken):
+        # remove all the data for relToken, even if they are inconsistent.
+        # Listeners are told only if the relationship was indexed.
+        removals = {}
+        for data in self._attrs.values():
+            name = data['name']
+            tokens = self._reltoken_name_TO_objtokenset.pop(
+                (relToken, name), None)
+            if tokens:
+                removals[name] = tokens
+            self._discard(relToken, tokens, name)
+        if relToken in self._relTokens:
+            self._relTokens.remove(relToken)
+            self._relLength.change(-1)
+            for listener in self._iterListeners():
+                listener.relationRemoved(relToken, self, removals)
+        self._changed()
+
+    def _checkPosting(self, name, token):
+        # return the relationship tokens in the posting of the value token
+        # that do not have the value, and whether the posting's count is wrong
+        length, rels = self._name_TO_mapping[name][token]
+        stale = []
+        for relToken in rels:
+            tokens = self._reltoken_name_TO_objtokenset.get((relToken, name))
+            if relToken not in self._relTokens or tokens is None or (
+                    token not in tokens):
+                stale.append(relToken)
+        return stale, length.value != len(rels)
+
+    def _repairPosting(self, name, token, stale):
+        dataset = self._name_TO_mapping[name]
+        length, rels = dataset[token]
+        for relToken in stale:
+            rels.remove(relToken)
+        if not rels:
+            del dataset[token]
+        elif length.value != len(rels):
+            length.set(len(rels))
+        self._changed()
+
     # disable search indexes
     _iterListeners = zc.relation.catalog.Catalog.iterListeners
     addSearchIndex = iterSearchIndexes = removeSearchIndex = None
@@ -190,7 +1688,7 @@ class Index(zc.relation.catalog.Catalog,
                     query.get('targetFilter'), getQueries) +
                     (True,)))
             # IF and LF have multiunion; can demand its presence
-            return data['multiunion'](tuple(iterable))
+            return _chunkedMultiunion(iterable, data)
         else:
             raise ValueError('unknown query type', searchType)
 
@@ -220,20 +1718,40 @@ class Index(zc.relation.catalog.Catalog,
 
     def findValueTokens(self, resultName, query=(), maxDepth=None,
                         filter=None, targetQuery=None, targetFilter=None,
-                        transitiveQueriesFactory=None, _ignored=None):
+                        transitiveQueriesFactory=None, _ignored=None,
+                        keepChains=True):
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
-        return super().findValueTokens(
-            resultName, query, maxDepth, filter, targetQuery, targetFilter,
-            transitiveQueriesFactory, True)
+        if not keepChains and maxDepth != 1:
+            return self._cached(
+                self._getCacheKey(
+                    ('reachable', resultName), query, maxDepth, filter,
+                    targetQuery, targetFilter, transitiveQueriesFactory),
+                lambda: self._findReachableValueTokens(
+                    resultName, query, maxDepth, filter, targetQuery,
+                    targetFilter, transitiveQueriesFactory))
+        return self._cached(
+            self._getCacheKey(
+                ('values', resultName), query, maxDepth, filter, targetQuery,
+                targetFilter, transitiveQueriesFactory),
+            lambda: super(Index, self).findValueTokens(
+                resultName, query, maxDepth, filter, targetQuery,
+                targetFilter, transitiveQueriesFactory, True))
 
     def findValues(self, resultName, query=(), maxDepth=None, filter=None,
                    targetQuery=None, targetFilter=None,
-                   transitiveQueriesFactory=None):
+                   transitiveQueriesFactory=None, keepChains=True):
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
+        if not keepChains:
+            return self.resolveValueTokens(
+                self.findValueTokens(
+                    resultName, query, maxDepth, filter, targetQuery,
+                    targetFilter, transitiveQueriesFactory,
+                    keepChains=False),
+                resultName)
         return super().findValues(
             resultName, query, maxDepth, filter, targetQuery, targetFilter,
             transitiveQueriesFactory)
@@ -244,9 +1762,10 @@ class Index(zc.relation.catalog.Catalog,
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
-        return super().findRelations(
-            query, maxDepth, filter, targetQuery, targetFilter,
-            transitiveQueriesFactory)
+        return self.resolveRelationshipTokens(
+            self.findRelationshipTokens(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                transitiveQueriesFactory))
 
     def findRelationshipTokens(self, query=(), maxDepth=None, filter=None,
                                targetQuery=None, targetFilter=None,
@@ -254,36 +1773,73 @@ class Index(zc.relation.catalog.Catalog,
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
-        return super().findRelationTokens(
-            query, maxDepth, filter, targetQuery, targetFilter,
-            transitiveQueriesFactory, True)
+        return self._cached(
+            self._getCacheKey(
+                'relationships', query, maxDepth, filter, targetQuery,
+                targetFilter, transitiveQueriesFactory),
+            lambda: super(Index, self).findRelationTokens(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                transitiveQueriesFactory, True))
 
     def findRelationshipTokenChains(self, query=(), maxDepth=None, filter=None,
                                     targetQuery=None, targetFilter=None,
-                                    transitiveQueriesFactory=None):
+                                    transitiveQueriesFactory=None,
+                                    limit=None, maxVisited=None,
+                                    timeBudget=None):
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
-        return super().findRelationTokenChains(
-            query, maxDepth, filter, targetQuery, targetFilter,
-            transitiveQueriesFactory)
+        if limit is not None or maxVisited is not None or (
+                timeBudget is not None):
+            return self._findBounded(
+                super().findRelationTokenChains, query, maxDepth, filter,
+                targetQuery, targetFilter, transitiveQueriesFactory,
+                limit, maxVisited, timeBudget)
+        return self._cached(
+            self._getCacheKey(
+                'chains', query, maxDepth, filter, targetQuery,
+                targetFilter, transitiveQueriesFactory),
+            lambda: super(Index, self).findRelationTokenChains(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                transitiveQueriesFactory))
 
     def findRelationshipChains(self, query=(), maxDepth=None, filter=None,
                                targetQuery=None, targetFilter=None,
-                               transitiveQueriesFactory=None):
+                               transitiveQueriesFactory=None,
+                               limit=None, maxVisited=None, timeBudget=None):
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
+        if limit is not None or maxVisited is not None or (
+                timeBudget is not None):
+            return self._findBounded(
+                super().findRelationChains, query, maxDepth, filter,
+                targetQuery, targetFilter, transitiveQueriesFactory,
+                limit, maxVisited, timeBudget)
         return super().findRelationChains(
             query, maxDepth, filter, targetQuery, targetFilter,
             transitiveQueriesFactory)
 
+    def _findBounded(self, find, query, maxDepth, filter, targetQuery,
+                     targetFilter, transitiveQueriesFactory, limit,
+                     maxVisited, timeBudget):
+        if maxVisited is not None or timeBudget is not None:
+            filter = _Bounds(maxVisited, timeBudget).wrapFilter(filter)
+        return BoundedResult(
+            find(query, maxDepth, filter, targetQuery, targetFilter,
+                 transitiveQueriesFactory),
+            limit)
+
     def isLinked(self, query=(), maxDepth=None, filter=None,
                  targetQuery=None, targetFilter=None,
                  transitiveQueriesFactory=None):
         # argument names changed slightly
         if targetQuery is None:
             targetQuery = ()
-        return super().canFind(
-            query, maxDepth, filter, targetQuery, targetFilter,
-            transitiveQueriesFactory)
+        return self._cached(
+            self._getCacheKey(
+                'isLinked', query, maxDepth, filter, targetQuery,
+                targetFilter, transitiveQueriesFactory),
+            lambda: super(Index, self).canFind(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                transitiveQueriesFactory))
@@ -18,7 +18,7 @@ $Id$
 import zc.relation.interfaces
 import zope.index.interfaces
 from zope import interface
-from zope.app.container.interfaces import IReadContainer
+from zope.container.interfaces import IReadContainer
 
 
 ICircularRelationshipPath = zc.relation.interfaces.ICircularRelationPath
@@ -62,23 +62,31 @@ class IIndex(zope.index.interfaces.IInjection,
 
     def findValueTokens(resultName, query=None, maxDepth=None, filter=None,
                         targetQuery=None, targetFilter=None,
-                        transitiveQueriesFactory=None):
+                        transitiveQueriesFactory=None, keepChains=True):
         """find token results for searchTerms.
         - resultName is the index name wanted for results.
         - if query is None (or evaluates to boolean False), returns the
           underlying btree data structure; which is an iterable result but
           can also be used with BTree operations
+        - if keepChains is False, the search does not build relationship
+          chains, but walks sets of relationship tokens, using much less
+          memory.  It finds every value reachable within maxDepth.  It
+          requires a TransposingTransitiveQueriesFactory with a query on one
+          of its names, and may not be combined with filter, targetQuery or
+          targetFilter.
         Otherwise, same arguments as findRelationshipChains.
         """
 
     def findValues(resultName, query=None, maxDepth=None, filter=None,
                    targetQuery=None, targetFilter=None,
-                   transitiveQueriesFactory=None):
+                   transitiveQueriesFactory=None, keepChains=True):
         """Like findValueTokens, but resolves value tokens"""
 
     def findRelationshipTokenChains(query, maxDepth=None, filter=None,
                                     targetQuery=None, targetFilter=None,
-                                    transitiveQueriesFactory=None):
+                                    transitiveQueriesFactory=None,
+                                    limit=None, maxVisited=None,
+                                    timeBudget=None):
         """find tuples of relationship tokens for searchTerms.
         - query is a dictionary of {indexName: token}
         - maxDepth is None or a positive integer that specifies maximum depth
@@ -97,11 +105,20 @@ class IIndex(zope.index.interfaces.IInjection,
           still be traversed)
         - optional transitiveQueriesFactory takes the place of the index's
           defaultTransitiveQueriesFactory
+        - limit is None or the maximum number of chains to return.
+        - maxVisited is None or the maximum number of relationships the
+          search may visit.
+        - timeBudget is None or the maximum number of seconds, from the call,
+          that the search may take.
+        If any of limit, maxVisited and timeBudget is given, the result is an
+        iterator with a `truncated` attribute, which is True once the
+        search has stopped at one of them before finding all results.
         """
 
     def findRelationshipChains(query, maxDepth=None, filter=None,
                                targetQuery=None, targetFilter=None,
-                               transitiveQueriesFactory=None):
+                               transitiveQueriesFactory=None,
+                               limit=None, maxVisited=None, timeBudget=None):
         "Like findRelationshipTokenChains, but resolves relationship tokens"
 
     def isLinked(query, maxDepth=None, filter=None, targetQuery=None,
@@ -118,6 +135,12 @@ class IIndex(zope.index.interfaces.IInjection,
         '''Given a dictionary of {indexName: value} returns a dictionary of
         {indexname: token} appropriate for the search methods'''
 
+    def tokenizeQueries(queries):
+        '''Given an iterable of dictionaries of {indexName: value} returns a
+        list of dictionaries of {indexname: token}, as tokenizeQuery would
+        return for each.  The values of the index names that share a dump
+        are tokenized together, sharing one cache.'''
+
     def resolveQuery(query):
         '''Given a dictionary of {indexName: token} returns a dictionary of
         {indexname: value}'''
@@ -156,6 +179,18 @@ class IIndex(zope.index.interfaces.IInjection,
         the btree family for the value) of value tokens for that relationship.
         """
 
+    def warmUp(maxBytes=None):
+        """Load the index data that searches use into the ZODB cache.
+
+        The BTrees of relationships, postings and values are loaded first,
+        a level at a time from the top; then the postings, largest first;
+        then the value sets of each relationship; then, if tokens are
+        intids, the intid utility's mapping of intids to objects.  Loading
+        stops once the estimated memory of the loaded objects reaches
+        `maxBytes`, if given.  Returns the number of objects loaded and their
+        estimated memory in bytes.
+        """
+
 
 class IRelationship(interface.Interface):
     """An asymmetric relationship."""
@@ -171,6 +206,21 @@ class IRelationship(interface.Interface):
         """Objects being pointed to in the relationship.  Readonly.""")
 
 
+class ITemporalRelationship(interface.Interface):
+    """A relationship that is only valid within a window of time.
+
+    The times may be datetimes, timestamps, or any other values, so long as
+    each container and the times given to its searches use comparable ones.
+    """
+
+    validFrom = interface.Attribute(
+        """The time from which the relationship is valid, or None for no
+        beginning.""")
+
+    validUntil = interface.Attribute(
+        """The time at which the relationship expires, or None for never.""")
+
+
 class IMutableRelationship(IRelationship):
     """An asymmetric relationship.  Sources and targets can be changed."""
 
@@ -199,9 +249,31 @@ class IManyToOneRelationship(ITargetRelationship):
     pass
 
 
+class ITokenRelationship(interface.Interface):
+    """An asymmetric relationship between tokens, such as intids.
+
+    Indexing it loads no related objects."""
+
+    __parent__ = interface.Attribute(
+        """The relationship container of which this relationship is a member
+        """)
+
+    sourceTokens = interface.Attribute(
+        """Tokens of the objects pointing in the relationship.  Readonly.""")
+
+    targetTokens = interface.Attribute(
+        """Tokens of the objects being pointed to in the relationship.
+        Readonly.""")
+
+
+class IMutableTokenRelationship(ITokenRelationship):
+    """A relationship between tokens.  Sources and targets can be changed."""
+
+
 class IBidirectionalRelationshipIndex(interface.Interface):
 
-    def findTargets(source, maxDepth=1, filter=None):
+    def findTargets(source, maxDepth=1, filter=None, keepChains=True,
+                    sort=None, limit=None, reverse=False):
         """Given a source, iterate over objects to which it points.
 
         maxDepth is the number of relationships through which the search
@@ -209,9 +281,19 @@ class IBidirectionalRelationshipIndex(interface.Interface):
 
         filter is an optional callable that takes a relationship and returns
         a boolean True value if it should be included, and a False if not.
+
+        If keepChains is False, the search walks sets of tokens rather than
+        relationship paths, which uses much less memory for deep searches.
+        It may not be combined with filter or minDepth.
+
+        sort is the name of a SortIndex installed as a listener of the
+        index; if given, the objects are returned in the order of their
+        keys, or the reverse order if reverse is true, and only the objects
+        returned are loaded.  limit is the most objects to return.
         """
 
-    def findSources(target, maxDepth=1, filter=None):
+    def findSources(target, maxDepth=1, filter=None, keepChains=True,
+                    sort=None, limit=None, reverse=False):
         """Given a target, iterate over objects that point to it.
 
         maxDepth is the number of relationships through which the search
@@ -219,6 +301,8 @@ class IBidirectionalRelationshipIndex(interface.Interface):
 
         filter is an optional callable that takes a relationship and returns
         a boolean True value if it should be included, and a False if not.
+
+        sort, limit and reverse are as for findTargets.
         """
 
     def isLinked(source=None, target=None, maxDepth=1, filter=None):
@@ -232,7 +316,8 @@ class IBidirectionalRelationshipIndex(interface.Interface):
         """
 
     def findRelationships(
-            source=None, target=None, maxDepth=1, filter=None):
+            source=None, target=None, maxDepth=1, filter=None, limit=None,
+            maxVisited=None, timeBudget=None):
         """given source, target, or both, iterate over all relationship paths.
 
         maxDepth is the number of relationships through which the search
@@ -244,17 +329,182 @@ class IBidirectionalRelationshipIndex(interface.Interface):
         If a cycle is found, it is omitted by default.  if includeCycles is
         True, it returns the cycle in an ICircularRelationshipPath and then
         does not continue down the cycle.
+
+        limit, maxVisited and timeBudget bound the search as described for
+        IIndex.findRelationshipTokenChains; if any is given, the result has a
+        `truncated` attribute.
         """
 
-    def findTargetTokens(source, maxDepth=1, filter=None):
+    def findTargetTokens(source, maxDepth=1, filter=None, keepChains=True,
+                         sort=None, limit=None, reverse=False):
         """As findTargets, but returns tokens rather than the objects"""
 
-    def findSourceTokens(source, maxDepth=1, filter=None):
+    def findSourceTokens(source, maxDepth=1, filter=None, keepChains=True,
+                         sort=None, limit=None, reverse=False):
         """As findSources, but returns tokens rather than the objects"""
 
-    def findRelationshipTokens(source, maxDepth=1, filter=None):
+    def findRelationshipTokens(source, maxDepth=1, filter=None, limit=None,
+                               maxVisited=None, timeBudget=None):
         """As findRelationships, but returns tokens rather than the objects"""
 
+    def findTargetsByDepth(source, maxDepth=None, filter=None):
+        """Given a source, iterate over tuples of targets, one per depth.
+
+        The first tuple holds the objects one relationship away, the second
+        the objects first reached two relationships away, and so on.  Each
+        object is included only once, at the shallowest depth at which it
+        can be found.  Iteration stops at maxDepth, or when a depth has no
+        new objects.
+
+        maxDepth is None or a positive integer.  filter is as for
+        findTargets.
+        """
+
+    def findSourcesByDepth(target, maxDepth=None, filter=None):
+        """Given a target, iterate over tuples of sources, one per depth.
+
+        The mirror of findTargetsByDepth.
+        """
+
+    def findTargetTokensByDepth(source, maxDepth=None, filter=None):
+        """As findTargetsByDepth, but iterates over sets of tokens"""
+
+    def findSourceTokensByDepth(target, maxDepth=None, filter=None):
+        """As findSourcesByDepth, but iterates over sets of tokens"""
+
+    def findCommonTargets(*sources):
+        """Return the objects that are direct targets of all of the sources.
+
+        The target sets of the sources are intersected, smallest first,
+        from the index postings; no relationships are loaded.  At least one
+        source is required.
+        """
+
+    def findCommonTargetTokens(*sources):
+        """As findCommonTargets, but returns a set of tokens"""
+
+    def findCommonSources(*targets):
+        """Return the objects that are direct sources of all of the targets.
+        """
+
+    def findCommonSourceTokens(*targets):
+        """As findCommonSources, but returns a set of tokens"""
+
+    def findSimilarSources(source, limit=10, measure='jaccard'):
+        """Return a list of up to `limit` (object, score) pairs for the other
+        sources that share direct targets with source, best first.
+
+        If measure is 'overlap', the score is the number of shared targets.
+        If it is 'jaccard', the score is that number divided by the number
+        of targets of either: 1.0 for the same targets.  Ties are ordered by
+        token.  limit may be None, for all of them.  The shared targets are
+        counted from the index postings, with weighted unions when the token
+        BTree module has them.
+        """
+
+    def findSimilarSourceTokens(source, limit=10, measure='jaccard'):
+        """As findSimilarSources, but with tokens instead of objects"""
+
+    def findSimilarTargets(target, limit=10, measure='jaccard'):
+        """As findSimilarSources, for targets that share direct sources"""
+
+    def findSimilarTargetTokens(target, limit=10, measure='jaccard'):
+        """As findSimilarTargets, but with tokens instead of objects"""
+
+    def findCycles():
+        """Iterate over the cycles of the whole graph.
+
+        Yields an (objects, relationships) pair of tuples for each strongly
+        connected component with a cycle: objects that can all reach one
+        another through relationships, and the relationships among them that
+        close the cycles.  A relationship from an object to itself is a
+        cycle.  The graph is scanned once, rather than searched from every
+        object.
+        """
+
+    def findCycleTokens():
+        """As findCycles, but iterates over pairs of token sets"""
+
+    def extractSubgraph(obj, maxDepth=1, direction='targets'):
+        """Return an ISubgraph of the objects near obj, and the relationships
+        among them, as tokens.
+
+        The objects are those within maxDepth relationships of obj (None
+        means no limit), following relationships from sources to targets if
+        direction is 'targets', from targets to sources if it is 'sources',
+        or both ways if it is 'both'.  The subgraph is built from the index
+        alone; no relationships are loaded.
+        """
+
+    def estimateReach(source, maxDepth=None, exact=False):
+        """Return (count, stale): about how many objects source reaches.
+
+        The estimate comes from the zc.relationship.index.ReachEstimator for
+        'source' and 'target' installed on the relationIndex, in constant
+        time; a ValueError is raised if there is none.  `stale` is the
+        estimator's flag: if relationships were removed since its sketches
+        were computed, the estimate may be too high.  Rebuilding it is left
+        to maintenance code.  Estimates are of the reach at any depth, so
+        maxDepth must be None.
+
+        If `exact` is true, the objects within maxDepth are counted instead,
+        as findTargetTokens with keepChains=False would find them, and
+        `stale` is False.  That takes time in proportion to the size of the
+        graph that source reaches.
+        """
+
+
+class ISubgraph(interface.Interface):
+    """Tokens of some objects and the relationships among them."""
+
+    nodes = interface.Attribute(
+        """A set of the value tokens of the objects, including the object
+        from which the subgraph was extracted.""")
+
+    relationships = interface.Attribute(
+        """A BTree mapping the token of each relationship with a source and a
+        target among the nodes to a (source tokens, target tokens) pair of
+        sets, limited to the nodes.""")
+
+
+class IVerificationProgress(interface.Interface):
+    """A report on a batch of a consistency check of a container."""
+
+    phase = interface.Attribute(
+        """What is being checked: 'relationships' (the relationships in the
+        container), 'index' (the relationship tokens in the index), or
+        'postings NAME' (the relationship tokens stored for each value token
+        of the NAME value index).""")
+
+    problems = interface.Attribute(
+        """A list of the problems found in the batch, each a tuple of a kind
+        and a relationship or value token:
+
+        - ('unindexed', relationship token): a relationship in the container
+          is not in the index.
+        - ('changed', relationship token, names): the data in the index for a
+          relationship do not match the values it has for the given names.
+        - ('orphaned', relationship token): the index has a relationship
+          that is not in the container.
+        - ('posting', value token, relationship tokens): the postings of the
+          value token list the relationships, which do not have the value, or
+          the count of its relationships is wrong.""")
+
+    repaired = interface.Attribute(
+        """Whether the problems were repaired.""")
+
+    checked = interface.Attribute(
+        """The number of items checked so far by this run of `verify`.""")
+
+    elapsed = interface.Attribute(
+        """The number of seconds since this run of `verify` started.""")
+
+    rate = interface.Attribute(
+        """The number of items checked per second by this run of `verify`.""")
+
+    done = interface.Attribute(
+        """Whether the verification is complete.""")
+
 
 class IRelationshipContainer(IReadContainer, IBidirectionalRelationshipIndex):
 
@@ -264,6 +514,71 @@ class IRelationshipContainer(IReadContainer, IBidirectionalRelationshipIndex):
     def remove(object):
         """Remove a relationship from the container"""
 
+    def removeRelationshipsFor(object):
+        """Remove every relationship that has object among its sources or
+        targets, and return how many were removed.
+
+        The relationships are found in the index postings for the object,
+        and unindexed by token.
+        """
+
+    def validAt(now, filter=None):
+        """Return a filter for the search methods of the container that
+        excludes the relationships that are not valid at the time `now`:
+        those that expired at or before it, and those that are not valid
+        until after it.
+
+        The relationships are excluded by their tokens, in the index of their
+        validity windows, without being loaded; the optional `filter` is
+        called with each of the others.  The container must have been created
+        with `indexValidity` true, or a ValueError is raised.  See
+        ITemporalRelationship.
+        """
+
+    def purgeExpired(now, batchSize=1000, commit=True):
+        """Remove the relationships that expired at or before `now`, and
+        return how many were removed.
+
+        The relationships are found in the index of their validity windows
+        and removed in batches of up to `batchSize`.  Unless `commit` is
+        false, each batch is committed, so that a purge of many
+        relationships does not make one large transaction.  As with
+        `verify`, the commits are made with the transaction manager of the
+        container's connection, the first comes before the first batch and
+        includes changes pending in that transaction, and a batch that hits
+        a conflict error is retried up to `conflictRetries` times in a row
+        before the error is raised.
+        """
+
+    def warmUp(maxBytes=None):
+        """Load the index data of the container into the ZODB cache.
+
+        See IIndex.warmUp."""
+
+    def verify(batchSize=1000, repair=False, commit=True):
+        """Check that the container and its index agree, in batches.
+
+        Returns an iterator that checks up to `batchSize` items each time it
+        is advanced, and produces an IVerificationProgress for the batch.
+        It checks the relationships in the container, then the relationship
+        tokens in the index, then the postings of each value index.  If
+        `repair` is true, problems are fixed as they are found.
+
+        Unless `commit` is false, each batch is committed along with a cursor
+        recording where it ended, so that the verification can proceed
+        while others write, and, if it is interrupted, a later call resumes
+        after the last committed batch.  The commits are made with the
+        transaction manager of the container's connection, and the first
+        comes before the first batch: changes pending in that transaction
+        are committed with it.  A batch that hits a conflict error is
+        aborted and retried, up to the container's `conflictRetries` times
+        in a row, and then the error is raised.
+
+        Without `repair`, nothing is tokenized for the first time: objects
+        are not registered with an intid utility to check them.  If
+        `commit` is false as well, the verification writes nothing.
+        """
+
 
 class IKeyReferenceRelationshipContainer(IRelationshipContainer):
     """holds relationships of objects that can be adapted to IKeyReference.
@@ -272,6 +587,13 @@ class IKeyReferenceRelationshipContainer(IRelationshipContainer):
     """
 
 
+class ITokenRelationshipContainer(IRelationshipContainer):
+    """holds ITokenRelationship objects.
+
+    The values used in searches, and those found, are the tokens themselves.
+    """
+
+
 class IIntIdRelationshipContainer(IRelationshipContainer):
     """relationships and the objects they relate must have/be given an intid.
 
@@ -15,13 +15,27 @@
 
 $Id$
 """
+import zope.intid.interfaces
+from zope import component
 from zope import interface
 
 from zc.relationship import interfaces
 from zc.relationship import shared
 
 
-def Container():
-    res = shared.Container()
+def Container(**kwargs):
+    res = shared.Container(**kwargs)
     interface.alsoProvides(res, interfaces.IIntIdRelationshipContainer)
     return res
+
+
+@component.adapter(zope.intid.interfaces.IIntIdRemovedEvent)
+def removeRelationshipsSubscriber(event):
+    """remove the relationships of an object that loses its intid.
+
+    Like ``shared.removeRelationshipsSubscriber``, for the containers that
+    use intids as tokens.  zope.intid sends the event before it unregisters
+    the object, so the relationships are still found.
+    """
+    shared._removeRelationshipsFor(
+        event.object, event.original_event.oldParent, True)
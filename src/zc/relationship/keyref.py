@@ -17,7 +17,7 @@ $Id$
 """
 from BTrees import OOBTree
 from zope import interface
-from zope.app.keyreference.interfaces import IKeyReference
+from zope.keyreference.interfaces import IKeyReference
 
 from zc.relationship import interfaces
 from zc.relationship import shared
@@ -39,10 +39,10 @@ def resolveRelToken(token, index, cache, **kwargs):
     return index.__parent__[token]
 
 
-def Container():
+def Container(**kwargs):
     res = shared.Container(
         generateObjToken, resolveObjToken, OOBTree,
         dumpRel=generateRelToken, loadRel=resolveRelToken,
-        relFamily=OOBTree)
+        relFamily=OOBTree, **kwargs)
     interface.alsoProvides(res, interfaces.IKeyReferenceRelationshipContainer)
     return res
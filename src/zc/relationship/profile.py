@@ -0,0 +1,263 @@
+##############################################################################
+#
+# Copyright (c) 2006-2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Report the shape of a relationship index in a ZODB FileStorage.
+
+usage: python -m zc.relationship.profile [--top N] Data.fs path/to/container
+
+The path is a slash-separated list of names from the database root to a
+relationship container or index.
+"""
+import argparse
+import heapq
+import sys
+
+import persistent
+import ZODB
+import ZODB.FileStorage
+
+from zc.relationship import index
+
+
+##############################################################################
+# BTree structure
+
+
+def _iterNodes(tree, depth=1):
+    # yield (depth, node, size) for the buckets of a BTree or TreeSet, and
+    # (depth, node, None) for its internal nodes.  A small tree keeps its only
+    # bucket inline, and yields it as (1, None, size).
+    tree._p_activate()
+    state = tree.__getstate__()
+    if state is None:
+        return
+    if len(state) == 1:
+        yield depth, None, len(tree)
+        return
+    yield depth, tree, None
+    children = state[0]
+    for child in children[::2]:
+        if isinstance(child, type(tree)):
+            yield from _iterNodes(child, depth + 1)
+        else:
+            yield depth + 1, child, len(child)
+
+
+def treeStatistics(tree):
+    """return a dictionary describing the structure of a BTree or TreeSet.
+
+    'depth' is the number of levels, 'buckets' the number of buckets,
+    'items' the number of keys, and 'fill' the mean fraction of the maximum
+    bucket size in use."""
+    depth = buckets = items = 0
+    for level, node, size in _iterNodes(tree):
+        depth = max(depth, level)
+        if size is not None:
+            buckets += 1
+            items += size
+    if buckets:
+        fill = items / (buckets * tree.max_leaf_size)
+    else:
+        fill = 0.0
+    return {'depth': depth, 'buckets': buckets, 'items': items,
+            'fill': fill}
+
+
+def _iterPersistent(tree):
+    # the persistent objects that store a BTree or TreeSet
+    yield tree
+    for level, node, size in _iterNodes(tree):
+        if node is not None and node is not tree:
+            yield node
+
+
+##############################################################################
+# index profile
+
+
+def _histogram(sizes):
+    # counts of sizes in power-of-two ranges: 1, 2-3, 4-7, ...
+    counts = {}
+    for size in sizes:
+        bits = size.bit_length()
+        counts[bits] = counts.get(bits, 0) + 1
+    return [(1 << (bits - 1), (1 << bits) - 1, counts[bits])
+            for bits in sorted(counts)]
+
+
+class _Storage:
+    # sums the pickle and estimated in-memory sizes of persistent objects
+
+    def __init__(self, jar):
+        self.jar = jar
+        if jar is not None:
+            self.storage = jar.db().storage
+        self.seen = 0
+        self.sizes = {}
+
+    def add(self, label, ob):
+        if not isinstance(ob, persistent.Persistent):
+            return
+        objects, pickled, estimated = self.sizes.get(label, (0, 0, 0))
+        if self.jar is not None and ob._p_oid is not None:
+            ob._p_activate()
+            pickled += len(self.storage.load(ob._p_oid)[0])
+            estimated += ob._p_estimated_size
+        self.sizes[label] = (objects + 1, pickled, estimated)
+        self.seen += 1
+        if self.jar is not None and not self.seen % 10000:
+            self.jar.cacheGC()
+
+    def addTree(self, label, tree):
+        for ob in _iterPersistent(tree):
+            self.add(label, ob)
+
+
+def profileIndex(ix, top=10):
+    """return a dictionary describing a zc.relationship index.
+
+    - 'relationships': the number of indexed relationships.
+    - 'attributes': for each indexed attribute name, a dictionary of the
+      number of distinct value 'tokens', the total 'postings' (token,
+      relationship pairs), a 'histogram' of (low, high, count) triples of
+      the number of tokens whose relationship count is in each range, and
+      the 'hubs': the `top` (token, relationship count) pairs with the most
+      relationships.
+    - 'trees': for each of the main BTrees, the result of treeStatistics.
+    - 'storage': for each part of the index, an (objects, pickle bytes,
+      estimated memory bytes) triple.  The byte counts are 0 if the index
+      is not stored in a database.
+    """
+    storage = _Storage(ix._p_jar)
+    storage.add('index', ix)
+    relTokens = ix.getRelationTokens()
+    trees = {'relationships': treeStatistics(relTokens)}
+    storage.addTree('relationships', relTokens)
+    attributes = {}
+    for info in ix.iterValueIndexInfo():
+        name = info['name']
+        postings = ix.getValueTokens(name)
+        trees['postings ' + name] = treeStatistics(postings)
+        storage.addTree('postings ' + name, postings)
+        sizes = []
+        hubs = []
+        for token, (length, rels) in postings.items():
+            size = length.value
+            storage.add('postings ' + name, length)
+            storage.addTree('postings ' + name, rels)
+            if not size:
+                continue
+            sizes.append(size)
+            if len(hubs) < top:
+                heapq.heappush(hubs, (size, len(sizes), token))
+            elif top and size > hubs[0][0]:
+                heapq.heapreplace(hubs, (size, len(sizes), token))
+        attributes[name] = {
+            'tokens': len(sizes),
+            'postings': sum(sizes),
+            'histogram': _histogram(sizes),
+            'hubs': [(token, size) for size, order, token in
+                     sorted(hubs, key=lambda h: (-h[0], h[1]))],
+        }
+    values = ix._reltoken_name_TO_objtokenset
+    trees['values'] = treeStatistics(values)
+    storage.addTree('values', values)
+    for tokens in values.values():
+        if tokens is not None:
+            storage.addTree('values', tokens)
+    return {'relationships': ix.documentCount(),
+            'attributes': attributes,
+            'trees': trees,
+            'storage': storage.sizes}
+
+
+def formatProfile(profile):
+    """return the text of a report of the result of profileIndex"""
+    lines = ['relationships: %d' % profile['relationships']]
+    for name, data in sorted(profile['attributes'].items()):
+        lines.append('')
+        lines.append('attribute %s: %d tokens, %d postings' % (
+            name, data['tokens'], data['postings']))
+        lines.append('  relationships per token:')
+        for low, high, count in data['histogram']:
+            if low == high:
+                label = str(low)
+            else:
+                label = '%d-%d' % (low, high)
+            lines.append('    %12s: %d' % (label, count))
+        if data['hubs']:
+            lines.append('  hubs:')
+            for token, size in data['hubs']:
+                lines.append('    %r: %d' % (token, size))
+    lines.append('')
+    lines.append('btrees:')
+    for label, data in sorted(profile['trees'].items()):
+        lines.append(
+            '  %s: depth %d, %d buckets, %d items, %.0f%% full' % (
+                label, data['depth'], data['buckets'], data['items'],
+                data['fill'] * 100))
+    lines.append('')
+    lines.append('storage (objects, pickle bytes, estimated memory bytes):')
+    total = [0, 0, 0]
+    for label, sizes in sorted(profile['storage'].items()):
+        lines.append('  %s: %d, %d, %d' % ((label,) + sizes))
+        total = [t + s for t, s in zip(total, sizes)]
+    lines.append('  total: %d, %d, %d' % tuple(total))
+    return '\n'.join(lines)
+
+
+##############################################################################
+# command line
+
+
+def traverse(root, path):
+    """return the object at the slash-separated path from root.
+
+    If it is a relationship container, return its relationship index."""
+    ob = root
+    for name in path.split('/'):
+        if name:
+            ob = ob[name]
+    return getattr(ob, 'relationIndex', ob)
+
+
+def main(argv=None, out=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m zc.relationship.profile',
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('storage', help='the path of a FileStorage')
+    parser.add_argument(
+        'path', help='slash-separated names from the root to a container')
+    parser.add_argument('--top', type=int, default=10,
+                        help='the number of hub tokens to show')
+    options = parser.parse_args(argv)
+    if out is None:
+        out = sys.stdout
+    storage = ZODB.FileStorage.FileStorage(options.storage, read_only=True)
+    db = ZODB.DB(storage)
+    try:
+        conn = db.open()
+        try:
+            ix = traverse(conn.root(), options.path)
+            if not isinstance(ix, index.Index):
+                parser.error('%r is not a relationship index or container'
+                             % options.path)
+            print(formatProfile(profileIndex(ix, options.top)), file=out)
+        finally:
+            conn.close()
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
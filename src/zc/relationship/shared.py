@@ -12,11 +12,23 @@
 #
 ##############################################################################
 """Relationship shared code."""
+import collections
+import heapq
+import itertools
 import random
+import sys
+import time
 
 import persistent
-import zope.app.container.btree
-import zope.app.container.contained
+import transaction
+import zc.relation.catalog
+import ZODB.POSException
+import zope.container.btree
+import zope.container.contained
+import zope.lifecycleevent.interfaces
+import zope.location.interfaces
+from BTrees import OOBTree
+from zope import component
 from zope import interface
 
 from zc.relationship import index
@@ -28,7 +40,7 @@ from zc.relationship import interfaces
 #
 
 class RelationshipBase(
-        persistent.Persistent, zope.app.container.contained.Contained):
+        persistent.Persistent, zope.container.contained.Contained):
     pass
 
 
@@ -36,14 +48,18 @@ def apply(func, *args, **kw):
     return func(*args, **kw)
 
 
-@interface.implementer(interfaces.IRelationship)
+@interface.implementer(
+    interfaces.IRelationship, interfaces.ITemporalRelationship)
 class ImmutableRelationship(RelationshipBase):
 
     _marker = __name__ = __parent__ = None
+    _validFrom = _validUntil = None
 
-    def __init__(self, sources, targets):
+    def __init__(self, sources, targets, validFrom=None, validUntil=None):
         self._sources = tuple(sources)
         self._targets = tuple(targets)
+        self._validFrom = validFrom
+        self._validUntil = validUntil
 
     @property
     def sources(self):
@@ -53,6 +69,14 @@ class ImmutableRelationship(RelationshipBase):
     def targets(self):
         return self._targets
 
+    @property
+    def validFrom(self):
+        return self._validFrom
+
+    @property
+    def validUntil(self):
+        return self._validUntil
+
     def __repr__(self):
         return f'<Relationship from {self.sources!r} to {self.targets!r}>'
 
@@ -84,6 +108,30 @@ class Relationship(ImmutableRelationship):
                 self.__parent__.reindex(self)
         return property(get, set)
 
+    @apply
+    def validFrom():
+        def get(self):
+            return self._validFrom
+
+        def set(self, value):
+            self._validFrom = value
+            if interfaces.IBidirectionalRelationshipIndex.providedBy(
+                    self.__parent__):
+                self.__parent__.reindex(self)
+        return property(get, set)
+
+    @apply
+    def validUntil():
+        def get(self):
+            return self._validUntil
+
+        def set(self, value):
+            self._validUntil = value
+            if interfaces.IBidirectionalRelationshipIndex.providedBy(
+                    self.__parent__):
+                self.__parent__.reindex(self)
+        return property(get, set)
+
 # some small conveniences; maybe overkill, but I wanted some for a client
 # package.
 
@@ -91,8 +139,8 @@ class Relationship(ImmutableRelationship):
 @interface.implementer(interfaces.IOneToOneRelationship)
 class OneToOneRelationship(ImmutableRelationship):
 
-    def __init__(self, source, target):
-        super().__init__((source,), (target,))
+    def __init__(self, source, target, validFrom=None, validUntil=None):
+        super().__init__((source,), (target,), validFrom, validUntil)
 
     @apply
     def source():
@@ -122,8 +170,8 @@ class OneToOneRelationship(ImmutableRelationship):
 @interface.implementer(interfaces.IOneToManyRelationship)
 class OneToManyRelationship(ImmutableRelationship):
 
-    def __init__(self, source, targets):
-        super().__init__((source,), targets)
+    def __init__(self, source, targets, validFrom=None, validUntil=None):
+        super().__init__((source,), targets, validFrom, validUntil)
 
     @apply
     def source():
@@ -153,8 +201,8 @@ class OneToManyRelationship(ImmutableRelationship):
 @interface.implementer(interfaces.IManyToOneRelationship)
 class ManyToOneRelationship(ImmutableRelationship):
 
-    def __init__(self, sources, target):
-        super().__init__(sources, (target,))
+    def __init__(self, sources, target, validFrom=None, validUntil=None):
+        super().__init__(sources, (target,), validFrom, validUntil)
 
     @apply
     def sources():
@@ -181,6 +229,68 @@ class ManyToOneRelationship(ImmutableRelationship):
         return property(get, set)
 
 ##############################################################################
+# relationships between tokens
+#
+# These store tokens, such as intids, instead of objects, so indexing them
+# loads no related objects and their pickles hold no object references.
+# They use slots, so they take little memory, but cannot directly provide
+# interfaces.
+
+
+@interface.implementer(
+    interfaces.ITokenRelationship, zope.location.interfaces.IContained)
+class ImmutableTokenRelationship(persistent.Persistent):
+
+    __slots__ = ('_sources', '_targets', '__name__', '__parent__')
+
+    def __init__(self, sourceTokens, targetTokens):
+        self._sources = tuple(sourceTokens)
+        self._targets = tuple(targetTokens)
+        self.__name__ = self.__parent__ = None
+
+    @property
+    def sourceTokens(self):
+        return self._sources
+
+    @property
+    def targetTokens(self):
+        return self._targets
+
+    def __repr__(self):
+        return '<TokenRelationship from {!r} to {!r}>'.format(
+            self.sourceTokens, self.targetTokens)
+
+
+@interface.implementer(interfaces.IMutableTokenRelationship)
+class TokenRelationship(ImmutableTokenRelationship):
+
+    __slots__ = ()
+
+    @apply
+    def sourceTokens():
+        def get(self):
+            return self._sources
+
+        def set(self, value):
+            self._sources = tuple(value)
+            if interfaces.IBidirectionalRelationshipIndex.providedBy(
+                    self.__parent__):
+                self.__parent__.reindex(self)
+        return property(get, set)
+
+    @apply
+    def targetTokens():
+        def get(self):
+            return self._targets
+
+        def set(self, value):
+            self._targets = tuple(value)
+            if interfaces.IBidirectionalRelationshipIndex.providedBy(
+                    self.__parent__):
+                self.__parent__.reindex(self)
+        return property(get, set)
+
+##############################################################################
 
 
 class ResolvingFilter:
@@ -193,24 +303,219 @@ class ResolvingFilter:
             relchain[-1])
         return self.filter(obj)
 
+    # equal filters let the index's query cache recognize repeated searches
+
+    def __eq__(self, other):
+        return (isinstance(other, ResolvingFilter) and
+                self.filter == other.filter and
+                self.container is other.container)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.filter, id(self.container)))
+
+
+class MinDepthFilter:
+    def __init__(self, depth):
+        self.depth = depth
+
+    def __call__(self, relchain, query, index, cache):
+        return len(relchain) >= self.depth
+
+    def __eq__(self, other):
+        return (isinstance(other, MinDepthFilter) and
+                self.depth == other.depth)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((MinDepthFilter, self.depth))
+
 
 def minDepthFilter(depth):
     if depth is None:
         return None
     if not isinstance(depth, int) or depth < 1:
         raise ValueError('invalid minDepth', depth)
-    return lambda relchain, query, index, cache: len(relchain) >= depth
+    return MinDepthFilter(depth)
+
+
+def _limited(iterable, limit):
+    if limit is None:
+        return iterable
+    if not isinstance(limit, int) or limit < 0:
+        raise ValueError('invalid limit', limit)
+    return itertools.islice(iterable, limit)
+
+
+class ValidityFilter:
+    """Excludes the relationships of a container that are not valid at a
+    time, by token, and passes the others to an optional filter of
+    relationships."""
+
+    def __init__(self, container, now, filter=None):
+        self.container = container
+        self.now = now
+        self.filter = filter
+        self.invalid = container._getInvalidRelationshipTokens(now)
+        self._others = {}
+
+    def _forContainer(self, container):
+        # the filter for the same time in another container, as a federated
+        # search needs; made once for each container
+        if container is self.container:
+            return self
+        res = self._others.get(id(container))
+        if res is None or res.container is not container:
+            res = self._others[id(container)] = container.validAt(
+                self.now, self.filter)
+        return res
+
+    def __call__(self, relchain, query, index, cache):
+        if relchain[-1] in self.invalid:
+            return False
+        return self.filter is None or self.filter(
+            index.resolveRelationshipToken(relchain[-1]))
+
+    def __eq__(self, other):
+        return (isinstance(other, ValidityFilter) and
+                self.now == other.now and self.filter == other.filter and
+                self.container is other.container)
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((ValidityFilter, self.now, self.filter,
+                     id(self.container)))
+
+
+@interface.implementer(interfaces.ISubgraph)
+class Subgraph:
+    def __init__(self, nodes, relationships):
+        self.nodes = nodes
+        self.relationships = relationships
+
+
+@interface.implementer(interfaces.IVerificationProgress)
+class VerificationProgress:
+    def __init__(self, phase, problems, repaired, checked, elapsed, done):
+        self.phase = phase
+        self.problems = problems
+        self.repaired = repaired
+        self.checked = checked
+        self.elapsed = elapsed
+        self.done = done
+
+    @property
+    def rate(self):
+        if not self.elapsed:
+            return 0.0
+        return self.checked / self.elapsed
+
+    def __repr__(self):
+        return '<%s %s: %d problems, %d checked%s>' % (
+            self.__class__.__name__, self.phase, len(self.problems),
+            self.checked, ', done' if self.done else '')
+
+
+def _byScore(item):
+    # order (token, score) pairs by descending score, then by token
+    return (-item[1], item[0])
+
+
+def _countTokens(sets, tools):
+    # a mapping of each token in the sets to the number of sets that have it.
+    # Modules with integer keys and numeric values merge the sets in C, with
+    # weighted unions, a pair at a time.
+    weightedUnion = getattr(
+        sys.modules[tools['TreeSet'].__module__], 'weightedUnion', None)
+    if weightedUnion is None:
+        res = collections.Counter()
+        for tokens in sets:
+            res.update(tokens)
+        return res
+    # the union of two sets is a set, so each set becomes a mapping first
+    empty = tools['Bucket']()
+    counts = [weightedUnion(empty, tokens)[1] for tokens in sets]
+    if not counts:
+        return empty
+    while len(counts) > 1:
+        counts = [weightedUnion(*counts[i:i + 2])[1] if i + 1 < len(counts)
+                  else counts[i] for i in range(0, len(counts), 2)]
+    return counts[0]
+
+
+class ByDepthMixin:
+    """Level-synchronous searches that produce their results depth by depth.
+
+    Each step expands the whole previous layer at once with `_expandTokens`,
+    which subclasses provide along with `relationIndex`.
+    """
+
+    def _iterTokensByDepth(self, token, fromName, toName, maxDepth, filter):
+        tools = self.relationIndex.getValueModuleTools(toName)
+        seen = tools['TreeSet']()
+        layer = (token,)
+        depth = 0
+        while maxDepth is None or depth < maxDepth:
+            depth += 1
+            found = self._expandTokens(layer, fromName, toName, filter)
+            if seen:
+                layer = tools['difference'](found, seen)
+            else:
+                layer = tools['Set'](found)  # never hand out index data
+            if not layer:
+                break
+            seen.update(layer)
+            yield layer
+
+    def _findTokensByDepth(self, value, fromName, toName, maxDepth, filter):
+        if maxDepth is not None and (
+                not isinstance(maxDepth, int) or maxDepth < 1):
+            raise ValueError('maxDepth must be None or a positive integer')
+        token = self.relationIndex.tokenizeQuery({fromName: value})[fromName]
+        return self._iterTokensByDepth(
+            token, fromName, toName, maxDepth, filter)
+
+    def findTargetTokensByDepth(self, source, maxDepth=None, filter=None):
+        return self._findTokensByDepth(
+            source, 'source', 'target', maxDepth, filter)
+
+    def findSourceTokensByDepth(self, target, maxDepth=None, filter=None):
+        return self._findTokensByDepth(
+            target, 'target', 'source', maxDepth, filter)
+
+    def findTargetsByDepth(self, source, maxDepth=None, filter=None):
+        resolve = self.relationIndex.resolveValueTokens
+        return (tuple(resolve(layer, 'target')) for layer in
+                self.findTargetTokensByDepth(source, maxDepth, filter))
+
+    def findSourcesByDepth(self, target, maxDepth=None, filter=None):
+        resolve = self.relationIndex.resolveValueTokens
+        return (tuple(resolve(layer, 'source')) for layer in
+                self.findSourceTokensByDepth(target, maxDepth, filter))
+
+
+class AbstractContainer(ByDepthMixin, persistent.Persistent):
+
+    # the relationship attributes to index, and defaults for their value index
+    # descriptions
+    _sourceElement = interfaces.IRelationship['sources']
+    _targetElement = interfaces.IRelationship['targets']
+    _valueIndexDefaults = {}
 
-class AbstractContainer(persistent.Persistent):
     def __init__(self,
                  dumpSource=None, loadSource=None, sourceFamily=None,
                  dumpTarget=None, loadTarget=None, targetFamily=None,
-                 **kwargs):
-        source = {'element': interfaces.IRelationship['sources'],
-                  'name': 'source', 'multiple': True}
-        target = {'element': interfaces.IRelationship['targets'],
-                  'name': 'target', 'multiple': True}
+                 indexValidity=False, **kwargs):
+        source = dict(self._valueIndexDefaults, element=self._sourceElement,
+                      name='source', multiple=True)
+        target = dict(self._valueIndexDefaults, element=self._targetElement,
+                      name='target', multiple=True)
         if dumpSource is not None:
             target['dump'] = source['dump'] = dumpSource
         if loadSource is not None:
@@ -224,8 +529,15 @@ class AbstractContainer(persistent.Persistent):
         if targetFamily is not None:
             target['btree'] = targetFamily
 
+        attrs = [source, target]
+        if indexValidity:
+            for name in ('validFrom', 'validUntil'):
+                attrs.append({
+                    'element': interfaces.ITemporalRelationship[name],
+                    'name': name, 'dump': None, 'load': None,
+                    'btree': OOBTree})
         ix = index.Index(
-            (source, target),
+            attrs,
             index.TransposingTransitiveQueriesFactory('source', 'target'),
             **kwargs)
         self.relationIndex = ix
@@ -235,47 +547,342 @@ class AbstractContainer(persistent.Persistent):
         assert object.__parent__ is self
         self.relationIndex.index(object)
 
-    def findTargets(self, source, maxDepth=1, minDepth=None, filter=None):
-        return self.relationIndex.findValues(
-            'target', self.relationIndex.tokenizeQuery({'source': source}),
-            maxDepth, filter and ResolvingFilter(filter, self),
-            targetFilter=minDepthFilter(minDepth))
-
-    def findSources(self, target, maxDepth=1, minDepth=None, filter=None):
-        return self.relationIndex.findValues(
-            'source', self.relationIndex.tokenizeQuery({'target': target}),
-            maxDepth, filter and ResolvingFilter(filter, self),
-            targetFilter=minDepthFilter(minDepth))
-
-    def findTargetTokens(self, source, maxDepth=1, minDepth=None, filter=None):
-        return self.relationIndex.findValueTokens(
-            'target', self.relationIndex.tokenizeQuery({'source': source}),
-            maxDepth, filter and ResolvingFilter(filter, self),
-            targetFilter=minDepthFilter(minDepth))
-
-    def findSourceTokens(self, target, maxDepth=1, minDepth=None, filter=None):
-        return self.relationIndex.findValueTokens(
-            'source', self.relationIndex.tokenizeQuery({'target': target}),
-            maxDepth, filter and ResolvingFilter(filter, self),
-            targetFilter=minDepthFilter(minDepth))
+    def warmUp(self, maxBytes=None):
+        return self.relationIndex.warmUp(maxBytes)
+
+    def _tokenFilter(self, filter):
+        # the filter for index searches.  Validity filters work with tokens;
+        # other filters are given relationships.
+        if not filter or isinstance(filter, ValidityFilter):
+            return filter or None
+        return ResolvingFilter(filter, self)
+
+    def _getValidityPostings(self, name):
+        ix = self.relationIndex
+        if name not in [info['name'] for info in ix.iterValueIndexInfo()]:
+            raise ValueError('validity windows are not indexed')
+        return ix.getValueTokens(name)
+
+    def _getInvalidRelationshipTokens(self, now):
+        # the relationships that expired at or before now, or that are not
+        # valid until after it
+        return zc.relation.catalog.multiunion(
+            itertools.chain(
+                (data[1] for data in
+                 self._getValidityPostings('validUntil').values(max=now)),
+                (data[1] for data in
+                 self._getValidityPostings('validFrom').values(
+                     min=now, excludemin=True))),
+            self.relationIndex.getRelationModuleTools())
+
+    def validAt(self, now, filter=None):
+        return ValidityFilter(self, now, filter)
+
+    def _getSortIndex(self, name):
+        for listener in self.relationIndex.iterListeners():
+            if isinstance(listener, index.SortIndex) and listener.name == name:
+                return listener
+        raise ValueError('no sort index', name)
+
+    def _findSortedTokens(self, value, fromName, toName, maxDepth, minDepth,
+                          filter, keepChains, sort, limit, reverse):
+        # the tokens of the search ordered by a sort index; only the tokens
+        # that are returned need be resolved.
+        sortIndex = self._getSortIndex(sort)
+        if maxDepth == 1 and minDepth is None:
+            tokens = self._expandTokens(
+                (self.relationIndex.tokenizeQuery(
+                    {fromName: value})[fromName],),
+                fromName, toName, filter)
+        else:
+            tokens = self.relationIndex.findValueTokens(
+                toName, self.relationIndex.tokenizeQuery({fromName: value}),
+                maxDepth, self._tokenFilter(filter),
+                targetFilter=minDepthFilter(minDepth), keepChains=keepChains)
+        return sortIndex.sortTokens(tokens, limit, reverse)
+
+    def _findValues(self, value, fromName, toName, maxDepth, minDepth, filter,
+                    keepChains, sort, limit, reverse):
+        if sort is not None:
+            return self.relationIndex.resolveValueTokens(
+                self._findSortedTokens(
+                    value, fromName, toName, maxDepth, minDepth, filter,
+                    keepChains, sort, limit, reverse),
+                toName)
+        res = self.relationIndex.findValues(
+            toName, self.relationIndex.tokenizeQuery({fromName: value}),
+            maxDepth, self._tokenFilter(filter),
+            targetFilter=minDepthFilter(minDepth), keepChains=keepChains)
+        return _limited(res, limit)
+
+    def _findValueTokens(self, value, fromName, toName, maxDepth, minDepth,
+                         filter, keepChains, sort, limit, reverse):
+        if sort is not None:
+            return iter(self._findSortedTokens(
+                value, fromName, toName, maxDepth, minDepth, filter,
+                keepChains, sort, limit, reverse))
+        res = self.relationIndex.findValueTokens(
+            toName, self.relationIndex.tokenizeQuery({fromName: value}),
+            maxDepth, self._tokenFilter(filter),
+            targetFilter=minDepthFilter(minDepth), keepChains=keepChains)
+        return _limited(res, limit)
+
+    def findTargets(self, source, maxDepth=1, minDepth=None, filter=None,
+                    keepChains=True, sort=None, limit=None, reverse=False):
+        return self._findValues(
+            source, 'source', 'target', maxDepth, minDepth, filter,
+            keepChains, sort, limit, reverse)
+
+    def findSources(self, target, maxDepth=1, minDepth=None, filter=None,
+                    keepChains=True, sort=None, limit=None, reverse=False):
+        return self._findValues(
+            target, 'target', 'source', maxDepth, minDepth, filter,
+            keepChains, sort, limit, reverse)
+
+    def findTargetTokens(self, source, maxDepth=1, minDepth=None, filter=None,
+                         keepChains=True, sort=None, limit=None,
+                         reverse=False):
+        return self._findValueTokens(
+            source, 'source', 'target', maxDepth, minDepth, filter,
+            keepChains, sort, limit, reverse)
+
+    def findSourceTokens(self, target, maxDepth=1, minDepth=None, filter=None,
+                         keepChains=True, sort=None, limit=None,
+                         reverse=False):
+        return self._findValueTokens(
+            target, 'target', 'source', maxDepth, minDepth, filter,
+            keepChains, sort, limit, reverse)
+
+    def _expandTokens(self, tokens, fromName, toName, filter=None):
+        # one step of a level-synchronous search: the set of `toName` tokens
+        # of the relationships that have any of `tokens` as a `fromName`.
+        ix = self.relationIndex
+        postings = ix.getValueTokens(fromName)
+        rels = zc.relation.catalog.multiunion(
+            (postings.get(t, (None, None))[1] for t in tokens),
+            ix.getRelationModuleTools())
+        if isinstance(filter, ValidityFilter):
+            filter = filter._forContainer(self)  # for federated searches
+            rels = ix.getRelationModuleTools()['difference'](
+                rels, filter.invalid)
+            filter = filter.filter
+        if filter is not None:
+            rels = [r for r in rels
+                    if filter(ix.resolveRelationshipToken(r))]
+        return zc.relation.catalog.multiunion(
+            (ix.findValueTokenSet(r, toName) for r in rels),
+            ix.getValueModuleTools(toName))
+
+    def _findCommonTokens(self, values, fromName, toName):
+        if not values:
+            raise ValueError('at least one %s is required' % (fromName,))
+        ix = self.relationIndex
+        tools = ix.getValueModuleTools(toName)
+        sets = sorted(
+            (self._expandTokens((token,), fromName, toName)
+             for token in ix.tokenizeValues(values, fromName)),
+            key=len)
+        res = tools['Set'](sets[0])  # never hand out index data
+        for tokens in sets[1:]:
+            if not res:
+                break
+            res = tools['intersection'](res, tokens)
+        return res
+
+    def findCommonTargetTokens(self, *sources):
+        return self._findCommonTokens(sources, 'source', 'target')
+
+    def findCommonSourceTokens(self, *targets):
+        return self._findCommonTokens(targets, 'target', 'source')
+
+    def findCommonTargets(self, *sources):
+        return self.relationIndex.resolveValueTokens(
+            self.findCommonTargetTokens(*sources), 'target')
+
+    def findCommonSources(self, *targets):
+        return self.relationIndex.resolveValueTokens(
+            self.findCommonSourceTokens(*targets), 'source')
+
+    def _findSimilarTokens(self, value, fromName, toName, limit, measure):
+        if measure not in ('jaccard', 'overlap'):
+            raise ValueError('invalid measure', measure)
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise ValueError('invalid limit', limit)
+        token = self.relationIndex.tokenizeQuery({fromName: value})[fromName]
+        neighbors = self._expandTokens((token,), fromName, toName)
+        counts = _countTokens(
+            (self._expandTokens((t,), toName, fromName) for t in neighbors),
+            self.relationIndex.getValueModuleTools(fromName))
+        res = []
+        for candidate, count in counts.items():
+            if candidate == token:
+                continue
+            count = int(count)
+            if measure == 'jaccard':
+                union = len(neighbors) + len(self._expandTokens(
+                    (candidate,), fromName, toName)) - count
+                res.append((candidate, count / union))
+            else:
+                res.append((candidate, count))
+        if limit is None:
+            return sorted(res, key=_byScore)
+        return heapq.nsmallest(limit, res, key=_byScore)
+
+    def findSimilarSourceTokens(self, source, limit=10, measure='jaccard'):
+        return self._findSimilarTokens(
+            source, 'source', 'target', limit, measure)
+
+    def findSimilarTargetTokens(self, target, limit=10, measure='jaccard'):
+        return self._findSimilarTokens(
+            target, 'target', 'source', limit, measure)
+
+    def _resolveScores(self, scores, name):
+        return list(zip(
+            self.relationIndex.resolveValueTokens(
+                [token for token, score in scores], name),
+            [score for token, score in scores]))
+
+    def findSimilarSources(self, source, limit=10, measure='jaccard'):
+        return self._resolveScores(
+            self.findSimilarSourceTokens(source, limit, measure), 'source')
+
+    def findSimilarTargets(self, target, limit=10, measure='jaccard'):
+        return self._resolveScores(
+            self.findSimilarTargetTokens(target, limit, measure), 'target')
+
+    def findCycleTokens(self):
+        return index.iterStronglyConnectedComponents(
+            self.relationIndex, 'source', 'target')
+
+    def findCycles(self):
+        ix = self.relationIndex
+        return ((tuple(ix.resolveValueTokens(values, 'source')),
+                 tuple(ix.resolveRelationshipTokens(rels)))
+                for values, rels in self.findCycleTokens())
+
+    def extractSubgraph(self, obj, maxDepth=1, direction='targets'):
+        if maxDepth is not None and (
+                not isinstance(maxDepth, int) or maxDepth < 1):
+            raise ValueError('maxDepth must be None or a positive integer')
+        if direction == 'targets':
+            steps = (('source', 'target'),)
+        elif direction == 'sources':
+            steps = (('target', 'source'),)
+        elif direction == 'both':
+            steps = (('source', 'target'), ('target', 'source'))
+        else:
+            raise ValueError('invalid direction', direction)
+        ix = self.relationIndex
+        multiunion = zc.relation.catalog.multiunion
+        tools = ix.getValueModuleTools('source')
+        relTools = ix.getRelationModuleTools()
+        nodes = tools['TreeSet']()
+        nodes.insert(ix.tokenizeQuery({'source': obj})['source'])
+        layer = nodes
+        depth = 0
+        while layer and (maxDepth is None or depth < maxDepth):
+            depth += 1
+            found = multiunion(
+                (self._expandTokens(layer, fromName, toName)
+                 for fromName, toName in steps),
+                tools)
+            layer = tools['difference'](found, nodes)
+            nodes.update(layer)
+        # the induced subgraph: every relationship from and to the nodes
+        postings = ix.getValueTokens('source')
+        intersection = tools['intersection']
+        relationships = zc.relation.catalog.getMapping(relTools)()
+        for rel in multiunion(
+                (postings.get(t, (None, None))[1] for t in nodes), relTools):
+            targets = intersection(ix.findValueTokenSet(rel, 'target'), nodes)
+            if targets:
+                relationships[rel] = (
+                    intersection(ix.findValueTokenSet(rel, 'source'), nodes),
+                    targets)
+        return Subgraph(nodes, relationships)
+
+    def estimateReach(self, source, maxDepth=None, exact=False):
+        if exact:  # walks everything that source reaches
+            return (sum(len(layer) for layer in
+                        self.findTargetTokensByDepth(source, maxDepth)),
+                    False)
+        if maxDepth is not None:
+            raise ValueError('only exact counts have a maxDepth')
+        estimator = self._getListener(index.ReachEstimator)
+        if estimator is None:
+            raise ValueError('no reach estimator')
+        return (estimator.estimateReach(
+                    self.relationIndex.tokenizeQuery(
+                        {'source': source})['source']),
+                estimator.stale)
+
+    def _getListener(self, klass):
+        for listener in self.relationIndex.iterListeners():
+            if isinstance(listener, klass) and listener.names == (
+                    'source', 'target'):
+                return listener
+        return None
+
+    def _findDirectRelationshipTokens(self, source, target):
+        # the relationships that have source among their sources and target
+        # among their targets: a single lookup if a PairIndex is installed,
+        # or an intersection of the two postings otherwise.
+        query = self.relationIndex.tokenizeQuery(
+            {'source': source, 'target': target})
+        pairs = self._getListener(index.PairIndex)
+        if pairs is not None:
+            return pairs.getRelationshipTokens(
+                query['source'], query['target'])
+        return self.relationIndex.findRelationshipTokenSet(query)
+
+    def _directChains(self, rels):
+        # the one-relationship chains that findRelationshipTokenChains would
+        # produce for rels, including the marker for reflexive relationships.
+        ix = self.relationIndex
+        intersection = ix.getValueModuleTools('target')['intersection']
+        for rel in rels:
+            cycled = intersection(ix.findValueTokenSet(rel, 'source'),
+                                  ix.findValueTokenSet(rel, 'target'))
+            if cycled:
+                yield index.CircularRelationshipPath(
+                    (rel,), [{'source': t} for t in cycled])
+            else:
+                yield (rel,)
+
+    def _isReachable(self, source, target):
+        # answer from a ReachabilityIndex, if one is installed and its labels
+        # are current; otherwise None.
+        reach = self._getListener(index.ReachabilityIndex)
+        if reach is None:
+            return None
+        query = self.relationIndex.tokenizeQuery(
+            {'source': source, 'target': target})
+        return reach.isReachable(query['source'], query['target'])
 
     def isLinked(self, source=None, target=None, maxDepth=1, minDepth=None,
                  filter=None):
         tokenize = self.relationIndex.tokenizeQuery
         if source is not None:
             if target is not None:
+                if maxDepth == 1 and minDepth is None and filter is None:
+                    return bool(self._findDirectRelationshipTokens(
+                        source, target))
+                if maxDepth is None and minDepth is None and filter is None:
+                    res = self._isReachable(source, target)
+                    if res is not None:
+                        return res
                 targetQuery = tokenize({'target': target})
             else:
                 targetQuery = None
             return self.relationIndex.isLinked(
                 tokenize({'source': source}),
-                maxDepth, filter and ResolvingFilter(filter, self),
+                maxDepth, self._tokenFilter(filter),
                 targetQuery,
                 targetFilter=minDepthFilter(minDepth))
         elif target is not None:
             return self.relationIndex.isLinked(
                 tokenize({'target': target}),
-                maxDepth, filter and ResolvingFilter(filter, self),
+                maxDepth, self._tokenFilter(filter),
                 targetFilter=minDepthFilter(minDepth))
         else:
             raise ValueError(
@@ -300,29 +907,44 @@ class AbstractContainer(persistent.Persistent):
                 yield i
 
     def findRelationshipTokens(self, source=None, target=None, maxDepth=1,
-                               minDepth=None, filter=None):
+                               minDepth=None, filter=None, limit=None,
+                               maxVisited=None, timeBudget=None):
         tokenize = self.relationIndex.tokenizeQuery
+        bounded = limit is not None or maxVisited is not None or (
+            timeBudget is not None)
         if source is not None:
             if target is not None:
+                if (maxDepth == 1 and minDepth is None and filter is None and
+                        not bounded):
+                    return self._forward(self._directChains(
+                        self._findDirectRelationshipTokens(source, target)))
                 targetQuery = tokenize({'target': target})
             else:
                 targetQuery = None
             res = self.relationIndex.findRelationshipTokenChains(
                 tokenize({'source': source}),
-                maxDepth, filter and ResolvingFilter(filter, self),
+                maxDepth, self._tokenFilter(filter),
                 targetQuery,
-                targetFilter=minDepthFilter(minDepth))
-            return self._forward(res)
+                targetFilter=minDepthFilter(minDepth), limit=limit,
+                maxVisited=maxVisited, timeBudget=timeBudget)
+            return self._transform(res, self._forward)
         elif target is not None:
             res = self.relationIndex.findRelationshipTokenChains(
                 tokenize({'target': target}),
-                maxDepth, filter and ResolvingFilter(filter, self),
-                targetFilter=minDepthFilter(minDepth))
-            return self._reverse(res)
+                maxDepth, self._tokenFilter(filter),
+                targetFilter=minDepthFilter(minDepth), limit=limit,
+                maxVisited=maxVisited, timeBudget=timeBudget)
+            return self._transform(res, self._reverse)
         else:
             raise ValueError(
                 'at least one of `source` and `target` must be provided')
 
+    def _transform(self, res, func):
+        # keep the truncation report of bounded searches
+        if isinstance(res, index.BoundedResult):
+            return res.map(func)
+        return func(res)
+
     def _resolveRelationshipChains(self, iterable):
         for i in iterable:
             chain = tuple(self.relationIndex.resolveRelationshipTokens(i))
@@ -332,17 +954,20 @@ class AbstractContainer(persistent.Persistent):
                 yield tuple(chain)
 
     def findRelationships(self, source=None, target=None, maxDepth=1,
-                          minDepth=None, filter=None):
-        return self._resolveRelationshipChains(
+                          minDepth=None, filter=None, limit=None,
+                          maxVisited=None, timeBudget=None):
+        return self._transform(
             self.findRelationshipTokens(
-                source, target, maxDepth, minDepth, filter))
+                source, target, maxDepth, minDepth, filter, limit,
+                maxVisited, timeBudget),
+            self._resolveRelationshipChains)
 
 
-class Container(AbstractContainer, zope.app.container.btree.BTreeContainer):
+class Container(AbstractContainer, zope.container.btree.BTreeContainer):
 
     def __init__(self, *args, **kwargs):
         AbstractContainer.__init__(self, *args, **kwargs)
-        zope.app.container.btree.BTreeContainer.__init__(self)
+        zope.container.btree.BTreeContainer.__init__(self)
 
     # subclass API
     def _generate_id(self, relationship):
@@ -365,7 +990,269 @@ class Container(AbstractContainer, zope.app.container.btree.BTreeContainer):
         self.relationIndex.unindex(object)
         super(AbstractContainer, self).__delitem__(key)
 
+    def _removeRelationshipTokens(self, tokens):
+        ix = self.relationIndex
+        indexed = ix.getRelationTokens()
+        res = 0
+        for token in tokens:
+            if token not in indexed:  # a subscriber removed it already
+                continue
+            try:
+                rel = ix.resolveRelationshipToken(token)
+            except KeyError:  # the relationship is gone: drop its data
+                ix._forgetRelationToken(token)
+                continue
+            ix.unindex_doc(token)
+            if self.get(rel.__name__) is rel:
+                super(AbstractContainer, self).__delitem__(rel.__name__)
+            res += 1
+        return res
+
+    def removeRelationshipsFor(self, object):
+        ix = self.relationIndex
+        sets = []
+        for name in ('source', 'target'):
+            token = ix._queryValueToken(object, name)
+            if token is not None:
+                sets.append(ix.getRelationTokens({name: token}))
+        # copy the tokens, since unindexing changes the postings
+        return self._removeRelationshipTokens(list(
+            zc.relation.catalog.multiunion(sets, ix.getRelationModuleTools())))
+
+    # the number of times a batch that hits a conflict error is retried,
+    # by verify and purgeExpired, before the error is raised
+    conflictRetries = 3
+
+    def _iterCommittedBatches(self, batch, commit):
+        # call batch until it returns None, and yield what it returns.  If
+        # commit is true, the transaction of the container's connection is
+        # committed before the first batch, with any changes of the caller,
+        # and after each batch; a batch that hits a conflict error is
+        # aborted and retried up to conflictRetries times.
+        if commit:
+            if self._p_jar is None:
+                manager = transaction.manager
+            else:
+                manager = self._p_jar.transaction_manager
+            manager.commit()
+        retries = 0
+        while True:
+            res = batch()
+            if res is None:
+                break
+            if commit:
+                try:
+                    manager.commit()
+                except ZODB.POSException.ConflictError:
+                    manager.abort()
+                    if retries >= self.conflictRetries:
+                        raise
+                    retries += 1
+                    continue
+                retries = 0
+                if self._p_jar is not None:
+                    self._p_jar.cacheGC()
+            yield res
+
+    def purgeExpired(self, now, batchSize=1000, commit=True):
+        if not isinstance(batchSize, int) or batchSize < 1:
+            raise ValueError('invalid batchSize', batchSize)
+
+        def purge():
+            ix = self.relationIndex
+            postings = self._getValidityPostings('validUntil')
+            batch = list(itertools.islice(
+                ((key, token) for key, data in postings.items(max=now)
+                 for token in data[1]),
+                batchSize))
+            if not batch:
+                return None
+            res = self._removeRelationshipTokens(
+                [token for key, token in batch])
+            # the tokens that are left are not of indexed relationships, but
+            # stray, as a failure may leave them: drop them, or each batch
+            # would find them again
+            stray = [(key, token) for key, token in batch
+                     if key in postings and token in postings[key][1]]
+            for key, token in stray:
+                ix._discard(token, (key,), 'validUntil')
+            if stray:
+                ix._changed()
+            return res
+
+        return sum(self._iterCommittedBatches(purge, commit))
+
     @property
     def __setitem__(self):
         raise AttributeError
     __delitem__ = __setitem__
+
+    # consistency checks
+
+    _verifyCursor = None  # (phase, last key checked) of an unfinished verify
+
+    def _getVerifyPhases(self):
+        ix = self.relationIndex
+        res = [('relationships', self._SampleContainer__data),
+               ('index', ix.getRelationTokens())]
+        for info in ix.iterValueIndexInfo():
+            res.append(
+                ('postings ' + info['name'], ix.getValueTokens(info['name'])))
+        return res
+
+    def _verifyRelationship(self, key, repair):
+        ix = self.relationIndex
+        rel = self._SampleContainer__data.get(key)
+        if rel is None:  # removed since the batch was read
+            return None
+        if repair:
+            token = ix.tokenizeRelationship(rel)
+        else:  # a check does not register new intids
+            token = ix._queryRelationToken(rel)
+        names = ix._checkRelationToken(token, rel, repair)
+        if names is None:
+            problem = ('unindexed', token)
+        elif names:
+            problem = ('changed', token, tuple(names))
+        else:
+            return None
+        if repair:
+            ix._forgetRelationToken(token)
+            ix.index_doc(token, rel)
+        return problem
+
+    def _verifyRelationToken(self, token, repair):
+        ix = self.relationIndex
+        if token not in ix.getRelationTokens():
+            return None
+        try:
+            rel = ix.resolveRelationshipToken(token)
+        except KeyError:
+            rel = None
+        name = getattr(rel, '__name__', None)
+        if (rel is not None and rel.__parent__ is self and name is not None
+                and self.get(name) is rel):
+            return None
+        if repair:
+            ix._forgetRelationToken(token)
+        return ('orphaned', token)
+
+    def _verifyPosting(self, name, token, repair):
+        ix = self.relationIndex
+        if token not in ix.getValueTokens(name):
+            return None
+        stale, badLength = ix._checkPosting(name, token)
+        if not stale and not badLength:
+            return None
+        if repair:
+            ix._repairPosting(name, token, stale)
+        return ('posting', token, tuple(stale))
+
+    def _verifyItem(self, phase, key, repair):
+        if phase == 'relationships':
+            return self._verifyRelationship(key, repair)
+        elif phase == 'index':
+            return self._verifyRelationToken(key, repair)
+        else:
+            return self._verifyPosting(phase[len('postings '):], key, repair)
+
+    def verify(self, batchSize=1000, repair=False, commit=True):
+        if not isinstance(batchSize, int) or batchSize < 1:
+            raise ValueError('invalid batchSize', batchSize)
+        start = time.monotonic()
+        # without commit, the cursor is kept here rather than written
+        state = {'cursor': self._verifyCursor}
+
+        def check():
+            phases = self._getVerifyPhases()
+            labels = [label for label, tree in phases]
+            cursor = self._verifyCursor if commit else state['cursor']
+            if cursor is None or cursor[0] not in labels:
+                cursor = (labels[0], None)
+            phase, last = cursor
+            position = labels.index(phase)
+            tree = phases[position][1]
+            if last is None:
+                keys = tree.keys()
+            else:
+                keys = tree.keys(min=last, excludemin=True)
+            batch = list(itertools.islice(keys, batchSize))
+            problems = []
+            for key in batch:
+                problem = self._verifyItem(phase, key, repair)
+                if problem is not None:
+                    problems.append(problem)
+            if len(batch) == batchSize:
+                cursor = (phase, batch[-1])
+            elif position + 1 < len(labels):
+                cursor = (labels[position + 1], None)
+            else:
+                cursor = None
+            if commit:
+                self._verifyCursor = cursor
+            state['cursor'] = cursor
+            return phase, problems, len(batch), cursor is None
+
+        checked = 0
+        for phase, problems, count, done in self._iterCommittedBatches(
+                check, commit):
+            checked += count
+            yield VerificationProgress(
+                phase, problems, bool(repair and problems), checked,
+                time.monotonic() - start, done)
+            if done:
+                break
+
+
+def _usesIntIds(container):
+    # whether the container tokenizes sources or targets with intids
+    return any(info['dump'] is index.generateToken
+               for info in container.relationIndex.iterValueIndexInfo()
+               if info['name'] in ('source', 'target'))
+
+
+def _removeRelationshipsFor(object, parent, intids):
+    # remove the relationships of object in the containers registered for
+    # its old parent that use intids, or in those that do not.  Removed
+    # relationships are skipped: they are removed by a container, which
+    # sends events for them too.
+    if (interfaces.IRelationship.providedBy(object) or
+            interfaces.ITokenRelationship.providedBy(object)):
+        return
+    for container in component.getAllUtilitiesRegisteredFor(
+            interfaces.IRelationshipContainer, context=parent):
+        if _usesIntIds(container) == intids:
+            container.removeRelationshipsFor(object)
+
+
+@component.adapter(zope.location.interfaces.ILocation,
+                   zope.lifecycleevent.interfaces.IObjectRemovedEvent)
+def removeRelationshipsSubscriber(object, event):
+    """remove the relationships of a removed object.
+
+    Each relationship container registered as an IRelationshipContainer
+    utility for the object's old parent removes the relationships that have
+    the object among their sources or targets.  Register it with
+    ``zope.component.provideHandler``, or with a ``subscriber`` directive.
+
+    Containers that use intids as tokens are skipped: by the time this
+    runs, the intid utility's subscriber may have unregistered the object.
+    Register ``zc.relationship.intid.removeRelationshipsSubscriber`` for
+    them as well.
+    """
+    _removeRelationshipsFor(object, event.oldParent, False)
+
+
+@interface.implementer(interfaces.ITokenRelationshipContainer)
+class TokenContainer(Container):
+    """A container of ITokenRelationship objects.
+
+    The tokens are indexed as they are, without dump or load functions, so
+    searches take and return tokens.  The value BTree family is IFBTree by
+    default; pass `sourceFamily` for another, such as LFBTree for 64 bit
+    tokens.
+    """
+
+    _sourceElement = interfaces.ITokenRelationship['sourceTokens']
+    _targetElement = interfaces.ITokenRelationship['targetTokens']
+    _valueIndexDefaults = {'dump': None, 'load': None}
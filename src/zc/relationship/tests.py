@@ -119,5 +119,11 @@ def test_suite():
         doctest.DocFileSuite(  # intidSetUp
             'container.rst', setUp=intidSetUp, tearDown=tearDown,
             optionflags=doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'federated.rst', setUp=intidSetUp, tearDown=tearDown),
+        doctest.DocFileSuite(
+            'tokens.rst', setUp=intidSetUp, tearDown=tearDown),
+        doctest.DocFileSuite('profile.rst'),
+        doctest.DocFileSuite('warmup.rst'),
     ))
     return res
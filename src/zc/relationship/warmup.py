@@ -0,0 +1,65 @@
+##############################################################################
+#
+# Copyright (c) 2006-2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load relationship indexes into the ZODB cache when a process starts.
+
+$Id$
+"""
+import threading
+
+import transaction
+
+from zc.relationship import profile
+
+
+def warmUpDatabase(db, paths, maxBytes=None, background=False):
+    """load the indexes at the given paths into the cache of a connection.
+
+    Each path is a slash-separated list of names from the database root to a
+    relationship container or index, and `maxBytes` limits the estimated
+    memory used for each.  The connection is returned to the database's
+    pool when done, so the next request that opens it finds a warm cache.
+
+    Returns a dictionary of the (objects, bytes) loaded for each path; or, if
+    `background` is true, the daemon thread that does the work.
+    """
+    if background:
+        thread = threading.Thread(
+            target=warmUpDatabase, args=(db, paths, maxBytes),
+            name='zc.relationship warm-up', daemon=True)
+        thread.start()
+        return thread
+    manager = transaction.TransactionManager()
+    conn = db.open(manager)
+    try:
+        root = conn.root()
+        return {path: profile.traverse(root, path).warmUp(maxBytes)
+                for path in paths}
+    finally:
+        manager.abort()
+        conn.close()
+
+
+def startupHandler(paths, maxBytes=None, background=True):
+    """return a handler that warms up the indexes when the database opens.
+
+    Register it for ``zope.processlifetime.IDatabaseOpenedWithRoot`` events,
+    or any other event with a `database` attribute::
+
+        zope.component.provideHandler(
+            startupHandler(['site/relationships']),
+            (zope.processlifetime.IDatabaseOpenedWithRoot,))
+    """
+    def handler(event):
+        warmUpDatabase(event.database, paths, maxBytes, background)
+    return handler